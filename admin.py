@@ -1,7 +1,10 @@
 from django.contrib import admin
+from django.urls import reverse
+from django.utils.html import format_html
 from handbooks.models import OrderStatus
 
 from orders import models
+from orders.api.service import enqueue_retailcrm_upload
 from orders.filters import OrderStatusFilter, OrderRetailCRMFilter
 from orders.utils import generate_order_number
 
@@ -88,7 +91,7 @@ class OrderAdmin(admin.ModelAdmin):
         (None, {
             'classes': ('suit-tab', 'suit-tab-retail'),
             'fields': (
-                'retailcrm_id', 'retail_crm_log'
+                'retailcrm_id', 'retailcrm_logs_link'
             )
         })
     )
@@ -110,7 +113,7 @@ class OrderAdmin(admin.ModelAdmin):
     readonly_fields = (
         'alt_id', 'created', 'order_number', 'income', 'items_amount', 'payment_status',
         'payment_gateway_order_id', 'payment_error_code', 'payment_error_message', 'retailcrm_id',
-        'total_amount', 'updated', 'retail_crm_log', 'utm_campaign', 'utm_content', 'utm_medium',
+        'total_amount', 'updated', 'retailcrm_logs_link', 'utm_campaign', 'utm_content', 'utm_medium',
         'utm_source', 'utm_term', 'comission'
     )
     search_fields = (
@@ -130,6 +133,14 @@ class OrderAdmin(admin.ModelAdmin):
         ('totals', 'Суммы'),
         ('retail', 'Retail CRM')
     )
+
+    @admin.display(description='Лог RetailCRM')
+    def retailcrm_logs_link(self, obj):
+        if not obj.pk:
+            return '-'
+        url = reverse('admin:orders_retailcrmlog_changelist')
+        return format_html('<a href="{}?order__id__exact={}">Открыть журнал</a>', url, obj.pk)
+
     def save_model(self, request, obj, form, change):
         if not obj.status_id:
             try:
@@ -141,4 +152,49 @@ class OrderAdmin(admin.ModelAdmin):
         if not obj.order_number:
             obj.order_number = generate_order_number()
 
-        return super(OrderAdmin, self).save_model(request, obj, form, change)
+        result = super(OrderAdmin, self).save_model(request, obj, form, change)
+        if not change:
+            enqueue_retailcrm_upload(obj)
+        return result
+
+    def save_formset(self, request, form, formset, change):
+        if formset.model is not models.OrderItem:
+            return super(OrderAdmin, self).save_formset(request, form, formset, change)
+
+        # позиции сохраняются без пересчета заказа, суммы пересчитываются один раз
+        items = formset.save(commit=False)
+        for item in formset.deleted_objects:
+            item.delete(update_order_totals=False)
+        for item in items:
+            item.save(update_order_totals=False)
+        formset.save_m2m()
+
+        if items or formset.deleted_objects:
+            form.instance.update_totals()
+            form.instance.save(update_totals=False)
+
+
+@admin.register(models.RetailCRMLog)
+class RetailCRMLogAdmin(admin.ModelAdmin):
+    """Журнал обмена с RetailCRM"""
+
+    date_hierarchy = 'created'
+    fields = ('order', 'created', 'text')
+    list_display = ('order', 'created', 'preview')
+    list_select_related = ('order',)
+    readonly_fields = fields
+    search_fields = ('order__order_number',)
+
+    @admin.display(description='Текст')
+    def text(self, obj):
+        return format_html('<pre style="white-space: pre-wrap">{}</pre>', obj.text)
+
+    @admin.display(description='Начало')
+    def preview(self, obj):
+        return obj.text[:100]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,94 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class OrderHistoryCursorPagination(BasePagination):
+    """Постраничный вывод истории заказов по курсору (created, id).
+
+    Следующая страница выбирается условием created < X OR (created = X AND id < Y) по индексу
+    (user, -created, -id), поэтому ее стоимость не зависит от глубины прокрутки и не требует
+    COUNT(*). Пагинация включается параметром cursor или page_size, без них история
+    отдается целиком, как раньше
+    """
+
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 20
+    max_page_size = 100
+    invalid_cursor_message = 'Неверный курсор'
+
+    def __init__(self):
+        self.request = None
+        self.has_next = False
+        self.page = []
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if self.cursor_query_param not in params and self.page_size_query_param not in params:
+            return None
+
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        cursor = params.get(self.cursor_query_param)
+        if cursor:
+            created, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+
+        rows = list(queryset.order_by('-created', '-id')[:page_size + 1])
+        self.has_next = len(rows) > page_size
+        self.page = rows[:page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data
+        })
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+
+        last = self.page[-1]
+        if isinstance(last, dict):
+            created, pk = last['created'], last['id']
+        else:
+            created, pk = last.created, last.pk
+
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param,
+            self.encode_cursor(created, pk)
+        )
+
+    @staticmethod
+    def encode_cursor(created, pk):
+        return base64.urlsafe_b64encode(f'{created.isoformat()}|{pk}'.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            created, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            created = parse_datetime(created)
+            pk = int(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if created is None:
+            raise NotFound(self.invalid_cursor_message)
+
+        return created, pk
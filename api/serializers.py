@@ -1,11 +1,13 @@
+from collections import defaultdict
+
 from rest_framework import serializers
 
 from catalog.api.serializers import ProductSerializer, ProductOfferCardListSerializer
 from catalog.models import ProductOfferCard
 from coupons.api.service import find_coupon
 from handbooks.enums import PaymentTypeEnum
-from handbooks.models import DeliveryType, PaymentType, Region
 from orders import models
+from orders.cache import get_delivery_type, get_payment_type, get_region
 from snippets.enums import PaymentStatusEnum
 from snippets.api.serializers import fields
 from vars.models import SiteConfig
@@ -30,6 +32,7 @@ class NewOrderSerializer(serializers.ModelSerializer):
     orders_issue_point = serializers.IntegerField(required=False, allow_null=True)
     delivery_amount = serializers.DecimalField(max_digits=11, decimal_places=2, required=False, allow_null=True)
     payment_type = serializers.IntegerField(required=True)
+    region = serializers.IntegerField(required=False, allow_null=True)
     delivery_date = serializers.DateField(required=False, allow_null=True)
     delivery_time = serializers.CharField(required=False, allow_null=True)
     utm_campaign = serializers.CharField(required=False, allow_null=True)
@@ -89,9 +92,8 @@ class NewOrderSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def validate_delivery_type(value):
-        try:
-            value = DeliveryType.objects.published().get(pk=value)
-        except DeliveryType.DoesNotExist:
+        value = get_delivery_type(value)
+        if value is None:
             raise serializers.ValidationError(
                 'Способ доставки не найден среди доступных вариантов'
             )
@@ -100,15 +102,25 @@ class NewOrderSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def validate_payment_type(value):
-        try:
-            value = PaymentType.objects.published().get(pk=value)
-        except PaymentType.DoesNotExist:
+        value = get_payment_type(value)
+        if value is None:
             raise serializers.ValidationError(
                 'Способ оплаты не найден среди доступных способов оплаты'
             )
 
         return value
 
+    @staticmethod
+    def validate_region(value):
+        if value:
+            value = get_region(value, published=False)
+            if value is None:
+                raise serializers.ValidationError(
+                    'Регион не найден среди доступных вариантов'
+                )
+
+        return value
+
 
 class OrderCalcPriceSerializer(serializers.ModelSerializer):
     """Стоимость заказа"""
@@ -135,9 +147,8 @@ class OrderCalcPriceSerializer(serializers.ModelSerializer):
     @staticmethod
     def validate_delivery_type(value):
         if value:
-            try:
-                value = DeliveryType.objects.published().get(pk=value)
-            except DeliveryType.DoesNotExist:
+            value = get_delivery_type(value)
+            if value is None:
                 raise serializers.ValidationError(
                     'Способ доставки не найден среди доступных вариантов'
                 )
@@ -147,9 +158,8 @@ class OrderCalcPriceSerializer(serializers.ModelSerializer):
     @staticmethod
     def validate_payment_type(value):
         if value:
-            try:
-                value = PaymentType.objects.published().get(pk=value)
-            except PaymentType.DoesNotExist:
+            value = get_payment_type(value)
+            if value is None:
                 raise serializers.ValidationError(
                     'Способ оплаты не найден среди доступных вариантов'
                 )
@@ -159,9 +169,8 @@ class OrderCalcPriceSerializer(serializers.ModelSerializer):
     @staticmethod
     def validate_region(value):
         if value:
-            try:
-                value = Region.objects.published().get(pk=value)
-            except Region.DoesNotExist:
+            value = get_region(value)
+            if value is None:
                 raise serializers.ValidationError(
                     'Регион не найден среди доступных вариантов'
                 )
@@ -192,10 +201,7 @@ class OrderListSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_items_count(obj):
-        if hasattr(obj, 'items_count'):
-            return obj.items_count
-
-        return obj.items.count()
+        return obj.items_count
 
     @staticmethod
     def get_is_online_pay(obj):
@@ -270,11 +276,42 @@ class OrderSimpleSerializer(serializers.ModelSerializer):
         # return OrderItemSimpleSerializer(items, many=True).data
 
 
-class OrderItemsHistorySerializer(serializers.ModelSerializer):
+class SparseFieldsMixin:
+    """Оставляет только поля из context['fields'] (None - все поля).
+
+    columns - колонки модели, нужные каждому полю, по ним строятся .only() и values()
+    """
+
+    columns = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        selected = self.context.get('fields')
+        if selected is not None:
+            for name in set(self.fields) - set(selected):
+                self.fields.pop(name)
+
+    @classmethod
+    def get_columns(cls, selected=None):
+        names = cls.Meta.fields if selected is None else selected
+        return list(dict.fromkeys(column for name in names for column in cls.columns[name]))
+
+
+class OrderItemsHistorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """Позиции заказа"""
     image = fields.ImageField(source='card.image')
     slug = serializers.SerializerMethodField()
 
+    columns = {
+        'id': (),
+        'image': ('card', 'card__image'),
+        'offer': ('offer',),
+        'price': ('price',),
+        'quantity': ('quantity',),
+        'size': ('size',),
+        'slug': ('card', 'card__slug'),
+    }
+
     class Meta:
         model = models.OrderItem
         fields = (
@@ -291,12 +328,22 @@ class OrderItemsHistorySerializer(serializers.ModelSerializer):
         return obj.card.slug
 
 
-class OrderHistorySerializer(serializers.ModelSerializer):
+class OrderHistorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """История заказов"""
-    total_count = serializers.IntegerField()
+    total_count = serializers.IntegerField(source='total_quantity')
     items = serializers.SerializerMethodField()
     status = serializers.SlugRelatedField(slug_field='title', read_only=True)
 
+    columns = {
+        'alt_id': ('alt_id',),
+        'delivery_date': ('delivery_date',),
+        'order_number': ('order_number',),
+        'status': ('status', 'status__title'),
+        'total_amount': ('total_amount',),
+        'total_count': ('total_quantity',),
+        'items': (),
+    }
+
     class Meta:
         model = models.Order
         fields = (
@@ -310,15 +357,22 @@ class OrderHistorySerializer(serializers.ModelSerializer):
         )
 
     def get_items(self, obj):
-        return OrderItemsHistorySerializer(obj.items, many=True).data
+        context = self.get_items_context(self.context)
+        return OrderItemsHistorySerializer(obj.items, many=True, context=context).data
 
+    @staticmethod
+    def get_items_context(context):
+        return {'fields': context.get('item_fields')}
 
-class OrderHistoryRetrieveSerializer(serializers.ModelSerializer):
+
+class OrderHistoryRetrieveSerializer(OrderHistorySerializer):
     """История заказов"""
-    total_count = serializers.IntegerField()
-    items = serializers.SerializerMethodField()
     delivery_price = serializers.SlugRelatedField(slug_field='delivery_type.price', read_only=True)
-    status = serializers.SlugRelatedField(slug_field='title', read_only=True)
+
+    columns = {
+        **OrderHistorySerializer.columns,
+        'delivery_price': ('delivery_type', 'delivery_type__price'),
+    }
 
     class Meta:
         model = models.Order
@@ -333,5 +387,89 @@ class OrderHistoryRetrieveSerializer(serializers.ModelSerializer):
             'items',
         )
 
-    def get_items(self, obj):
-        return OrderItemsHistorySerializer(obj.items, many=True).data
+
+class OrderHistoryListRenderer:
+    """История заказов из values()-выборки без сериализаторов.
+
+    Дает тот же JSON, что и OrderHistorySerializer: значения проходят через to_representation
+    тех же полей, а связанные объекты заменены колонками из JOIN. Позиции всех заказов
+    выбираются одним запросом, ссылка на каждую картинку строится один раз.
+    context - контекст сериализатора из view.get_serializer_context(), в нем же выбранные
+    поля заказа и позиций fields/item_fields (None - все поля)
+    """
+
+    def __init__(self, context=None):
+        context = context or {}
+        fields, item_fields = context.get('fields'), context.get('item_fields')
+        self.fields = [
+            name for name in OrderHistorySerializer.Meta.fields if fields is None or name in fields
+        ]
+        self.item_fields = [
+            name for name in OrderItemsHistorySerializer.Meta.fields
+            if item_fields is None or name in item_fields
+        ]
+        self.columns = OrderHistorySerializer.get_columns(self.fields)
+        self.item_columns = OrderItemsHistorySerializer.get_columns(self.item_fields)
+
+        # поля сериализаторов нужны все, выбранные уже в self.fields и self.item_fields
+        order_fields = OrderHistorySerializer(context={**context, 'fields': None}).fields
+        item_fields = OrderItemsHistorySerializer(
+            context={**OrderHistorySerializer.get_items_context(context), 'fields': None}
+        ).fields
+        self.image_field = item_fields['image']
+        self.image_model_field = ProductOfferCard._meta.get_field('image')
+        self.images = {}
+
+        self.order_getters = {
+            'alt_id': column_getter(order_fields['alt_id'], 'alt_id'),
+            'delivery_date': column_getter(order_fields['delivery_date'], 'delivery_date'),
+            'order_number': column_getter(order_fields['order_number'], 'order_number'),
+            'status': lambda row: row['status__title'],
+            'total_amount': column_getter(order_fields['total_amount'], 'total_amount'),
+            'total_count': column_getter(order_fields['total_count'], 'total_quantity'),
+        }
+        self.item_getters = {
+            'id': column_getter(item_fields['id'], 'id'),
+            'image': lambda row: self.get_image(row['card__image']) if row['card'] is not None else None,
+            'offer': lambda row: row['offer'],
+            'price': column_getter(item_fields['price'], 'price'),
+            'quantity': column_getter(item_fields['quantity'], 'quantity'),
+            'size': column_getter(item_fields['size'], 'size'),
+            'slug': lambda row: row['card__slug'],
+        }
+
+    def render(self, orders):
+        items = defaultdict(list)
+        if 'items' in self.fields and orders:
+            queryset = models.OrderItem.objects.filter(
+                order_id__in=[order['id'] for order in orders]
+            ).order_by('created').values('id', 'order_id', *self.item_columns)
+            item_getters = [(name, self.item_getters[name]) for name in self.item_fields]
+            for row in queryset:
+                items[row['order_id']].append({name: getter(row) for name, getter in item_getters})
+
+        order_getters = [(name, self.order_getters.get(name)) for name in self.fields]
+        return [
+            {
+                name: getter(order) if getter is not None else items[order['id']]
+                for name, getter in order_getters
+            }
+            for order in orders
+        ]
+
+    def get_image(self, name):
+        if name not in self.images:
+            field_file = self.image_model_field.attr_class(None, self.image_model_field, name)
+            self.images[name] = self.image_field.to_representation(field_file)
+        return self.images[name]
+
+
+def column_getter(field, column):
+    """Значение колонки через to_representation поля, None - как в Serializer.to_representation"""
+    to_representation = field.to_representation
+
+    def get(row):
+        value = row[column]
+        return None if value is None else to_representation(value)
+
+    return get
@@ -1,31 +1,186 @@
+import datetime
+import hashlib
+import json
 import traceback
+from collections import defaultdict
 from decimal import Decimal
 
 import retailcrm
-from carts.api.service import get_cart_items_amount
+from carts import MIN_AVAILABILITY
+from carts.api.service import get_cart, get_cart_items_amount, remove_cart_item
+from catalog.models import ProductOffer
 from coupons.api.service import (
     calculate_coupon_delivery_discount,
     calculate_coupon_items_discount,
 )
 from coupons.enums import ItemsPercentagePriceTypeEnum
+from coupons.models import Coupon, CouponEntry
 from django.conf import settings
-from django.db import transaction
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Prefetch, Q, When
+from django.http import HttpRequest
 from django.utils import timezone
 from handbooks.api.service import get_order_statuses_codes
 from handbooks.enums import DeliveryCalcPriceMethodEnum, PaymentTypeEnum
-from handbooks.models import DeliveryRegion
+from handbooks.models import DeliveryType, PaymentType
 from integrations.api.alpha import check_alpha_order_status
 from integrations.api.payselection import PayselectionAPI, PayselectionRusAPI
 from integrations.api.podeli.error import BnlpStatusError
 from integrations.api.podeli_api import PodeliAPI
 from integrations.api.yookassa import YookassaAPI
 from integrations.services import create_retail_user
-from orders import models
+from orders import models, pricing
+from orders.cache import get_cached_cart_id, get_calc_price_versions, get_delivery_region, \
+    invalidate_cart, invalidate_order_history, set_cached_cart_id
+from orders.enums import OrderNotificationKindEnum, OrderNotificationStatusEnum, RetailCRMSyncStatusEnum
 from orders.models import Order
+from orders.pricing import PricingRules, calc_totals
 from users.models import UserAddress
+from vars.models import SiteConfig, MenuItem
 
-from snippets.enums import PaymentStatusEnum
+from snippets.enums import PaymentStatusEnum, StatusEnum
 from snippets.forms.validators import valid_email
+from snippets.utils.email import send_email, send_trigger_email
+
+IDEMPOTENCY_KEY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = datetime.timedelta(minutes=1)
+NOTIFICATION_LEASE = datetime.timedelta(minutes=10)
+NOTIFICATION_REQUEST_META = (
+    'HTTP_HOST', 'HTTP_REFERER', 'HTTP_USER_AGENT', 'HTTP_X_FORWARDED_FOR', 'HTTP_X_FORWARDED_PROTO',
+    'PATH_INFO', 'REMOTE_ADDR', 'SERVER_NAME', 'SERVER_PORT', 'wsgi.url_scheme'
+)
+RETAIL_CRM_UPLOAD_LIMIT = 50
+RETAIL_CRM_MAX_ATTEMPTS = 8
+RETAIL_CRM_RETRY_DELAY = datetime.timedelta(minutes=5)
+ORDERS_HISTORY_CURSOR = 'orders_history'
+RETAIL_CRM_IMPORT_FIELDS = (
+    'delivery_type', 'payment_type', 'payment_status', 'coupon', 'coupon_entry',
+    *Order.totals_fields, 'updated'
+)
+
+
+def acquire_amounts(cart, cart_items):
+    """Проверяет наличие товаров корзины и резервирует их на складе.
+
+    Остатки всех предложений читаются одним запросом с блокировкой строк
+    (SELECT ... FOR UPDATE в порядке id, чтобы параллельные заказы не блокировали друг друга
+    накрест) и списываются одним UPDATE. Вызывается внутри transaction.atomic().
+    Возвращает текст ошибки, если позиции корзины пришлось удалить или уменьшить
+    """
+    amounts = dict(
+        ProductOffer.objects.select_for_update()
+        .filter(pk__in={x.offer_id for x in cart_items})
+        .order_by('pk')
+        .values_list('pk', 'amount')
+    )
+
+    removed_cart_items = []
+    decreased_cart_items = []
+    reserved = defaultdict(int)
+    for cart_item in cart_items:
+        amount = amounts.get(cart_item.offer_id) or 0
+        if amount < MIN_AVAILABILITY:
+            removed_cart_items.append(cart_item)
+            continue
+
+        if cart_item.quantity > amount:
+            cart_item.quantity = amount
+            decreased_cart_items.append(cart_item)
+
+        amounts[cart_item.offer_id] = amount - cart_item.quantity
+        reserved[cart_item.offer_id] += cart_item.quantity
+
+    if decreased_cart_items:
+        type(decreased_cart_items[0]).objects.bulk_update(decreased_cart_items, ['quantity'])
+
+    # bulk_update не отправляет сигналов, версия корзины для кеша расчета стоимости меняется явно
+    for cart_id in {x.cart_id for x in removed_cart_items + decreased_cart_items}:
+        invalidate_cart(cart_id)
+
+    if removed_cart_items:
+        for cart_item in removed_cart_items:
+            remove_cart_item(cart, cart_item.id)
+
+        if len(cart_items) == 1:
+            return 'Товар закончился'
+        if len(removed_cart_items) == len(cart_items):
+            return 'Все товары из корзины закончились'
+        return 'Некоторые товары из корзины закончились'
+
+    if decreased_cart_items:
+        return (
+            'Количество товара на складе недостаточно для оформления заказа и было '
+            'уменьшено до доступного количества. '
+            'Вы можете оформить заказ с новым количеством товара.'
+        )
+
+    ProductOffer.objects.filter(pk__in=reserved).update(amount=Case(
+        *[When(pk=offer_id, then=F('amount') - quantity) for offer_id, quantity in reserved.items()],
+        default=F('amount')
+    ))
+
+    return None
+
+
+def get_idempotency_key(request, user=None):
+    """Ключ идемпотентности запроса.
+
+    Ключ клиента хешируется вместе с адресом и пользователем, чтобы ключи разных
+    эндпоинтов и пользователей не пересекались
+    """
+    key = request.META.get(IDEMPOTENCY_KEY_HEADER, '').strip()
+    if not key:
+        return None
+
+    return hashlib.sha256(
+        f'{request.path}:{user.pk if user else ""}:{key}'.encode()
+    ).hexdigest()
+
+
+def get_idempotent_response(key):
+    """Сохраненный ответ на запрос с этим ключом (один запрос по уникальному индексу)"""
+    if not key:
+        return None
+
+    return models.OrderIdempotencyKey.objects.filter(
+        key=key, response__isnull=False
+    ).values_list('response', flat=True).first()
+
+
+def lock_idempotency_key(key, user=None):
+    """Создает и блокирует запись ключа в транзакции оформления заказа.
+
+    Если тот же ключ обрабатывается параллельным запросом, вставка ждет завершения его
+    транзакции, после чего возвращается уже сохраненная запись с ответом
+    """
+    if not key:
+        return None
+
+    record, _ = models.OrderIdempotencyKey.objects.select_for_update().get_or_create(
+        key=key, defaults={'user': user}
+    )
+    return record
+
+
+def release_idempotency_key(record) -> None:
+    """Удаляет запись ключа, если заказ не оформлен.
+
+    Откатывать транзакцию нельзя: позиции корзины, которые acquire_amounts удалил или уменьшил,
+    должны сохраниться. Без записи повтор запроса с тем же ключом оформит заказ заново,
+    а не получит пустой ответ
+    """
+    if record is not None:
+        record.delete()
+
+
+def save_idempotent_response(record, order: Order, response: dict) -> None:
+    if record is None:
+        return
+
+    record.order = order
+    record.response = response
+    record.save(update_fields=('order', 'response', 'updated'))
 
 
 def accept_payment(order):
@@ -49,20 +204,15 @@ def calc_delivery_amount(delivery_type, region=None):
     if not region:
         return None
 
-    try:
-        delivery_region = DeliveryRegion.objects.published().filter(
-            delivery_type=delivery_type
-        ).get(region=region)
-    except (DeliveryRegion.DoesNotExist, DeliveryRegion.MultipleObjectsReturned):
+    delivery_region = get_delivery_region(delivery_type, region)
+    if delivery_region is None:
         return None
 
     return delivery_region.price if not delivery_type.is_price_from else 0
 
 
 def calc_amounts(cart_items, items_amount, validated_data):
-    coupon_amount = Decimal(0)
-    discount_amount = Decimal(0)
-    delivery_amount = Decimal(validated_data.get('delivery_amount', 0))
+    delivery_amount = Decimal(validated_data.get('delivery_amount') or 0)
 
     # delivery_type = validated_data.get('delivery_type')
     # region = validated_data.get('region')
@@ -70,83 +220,370 @@ def calc_amounts(cart_items, items_amount, validated_data):
     #     delivery_amount = float(calc_delivery_amount(delivery_type, region=region) or .0)
 
     coupon = validated_data.get('coupon')
-    bonuses = validated_data.get('bonuses')
-    coupon_delivery_amount = Decimal(0)
+    payment_type = validated_data.get('payment_type')
+    coupon_items_discount = Decimal(0)
+    coupon_delivery_discount = Decimal(0)
 
     if coupon and items_amount:
         amount_for_coupon = items_amount
         if coupon.items_percentage_price_type == ItemsPercentagePriceTypeEnum.PRICE:
             amount_for_coupon = get_cart_items_amount(cart_items, base_price=True)
 
-        discount_amount = Decimal(calculate_coupon_items_discount(coupon, cart_items) or 0)
+        coupon_items_discount = Decimal(calculate_coupon_items_discount(coupon, cart_items) or 0)
 
-        coupon_delivery_amount = Decimal(0)
         if delivery_amount:
-            coupon_delivery_amount = Decimal(calculate_coupon_delivery_discount(
+            coupon_delivery_discount = Decimal(calculate_coupon_delivery_discount(
                 coupon,
                 amount_for_coupon,
                 delivery_amount
             ) or 0)
-            delivery_amount -= coupon_delivery_amount
-        coupon_amount = discount_amount
 
-    total_amount = Decimal(items_amount) + delivery_amount - (discount_amount or 0) - (bonuses or 0)
-    discount_amount += coupon_delivery_amount
+    totals = calc_totals(items_amount, PricingRules(
+        comission_percent=payment_type.comission_percent if payment_type else 0,
+        delivery_amount=delivery_amount,
+        coupon_items_discount=coupon_items_discount,
+        coupon_delivery_discount=coupon_delivery_discount,
+        bonus_amount=validated_data.get('bonuses')
+    ))
 
     return {
-        'coupon_amount': coupon_amount,
-        'delivery_amount': delivery_amount,
-        'discount_amount': discount_amount,
+        'coupon_amount': totals.coupon_amount,
+        'delivery_amount': totals.delivery_amount,
+        'discount_amount': totals.discount_amount,
         'items_amount': items_amount,
-        'total_amount': total_amount
+        'total_amount': totals.total_amount
     }
 
 
+def get_cart_owner(request, user=None):
+    """Владелец корзины для ключей кеша: пользователь или сессия (None - сессии еще нет)"""
+    if user is not None:
+        return f'user:{user.pk}'
+
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    return f'session:{session_key}' if session_key else None
+
+
+def get_calc_price_cache_key(request, data, user=None):
+    """Ключ кеша расчета стоимости: параметры запроса, пользователь (от него зависит
+    применимость промокода), версии справочников, корзины и использований промокода.
+
+    Корзина учитывается версией, которую меняют сигналы позиций корзины, поэтому повторный
+    расчет не обращается к БД. ID корзины владельца запоминается в кеше при первом расчете.
+    Цены предложений в ключ не входят и обновляются по истечении CALC_PRICE_CACHE_TIMEOUT.
+    None - результат не кешируется
+    """
+    owner = get_cart_owner(request, user)
+    if owner is None:
+        return None
+
+    passphrase = str(data.get('coupon') or '')
+    cart_id = get_cached_cart_id(owner)
+    versions = get_calc_price_versions(cart_id, passphrase) if cart_id is not None else None
+    if versions is None:
+        cart = get_cart(request, user=user)[0]
+        if not cart:
+            return None
+        cart_id = cart.pk
+        set_cached_cart_id(owner, cart_id)
+        versions = get_calc_price_versions(cart_id, passphrase)
+        if versions is None:
+            return None
+
+    params = [
+        str(data.get(name) or '') for name in ('coupon', 'delivery_type', 'payment_type', 'region')
+    ]
+    fingerprint = repr((versions, cart_id, params, user.pk if user else None))
+
+    return 'orders:calc-price:%s' % hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+def build_order_items(cart_items) -> list:
+    """Позиции заказа из позиций корзины (без сохранения в БД)"""
+    return [
+        models.OrderItem(
+            offer=cart_item.offer,
+            card=cart_item.card,
+            size=cart_item.size,
+            quantity=cart_item.quantity,
+            price=cart_item.price,
+        )
+        for cart_item in cart_items
+    ]
+
+
+def create_order(order: Order, order_items: list) -> Order:
+    """Сохраняет заказ вместе с позициями.
+
+    Суммы считаются один раз в памяти по переданным позициям, заказ записывается одним INSERT,
+    позиции - одним bulk_create, поэтому число запросов не зависит от размера корзины
+    """
+    order.update_totals(items=order_items)
+    order.save(update_totals=False)
+
+    for order_item in order_items:
+        order_item.order = order
+    models.OrderItem.objects.bulk_create(order_items)
+    enqueue_retailcrm_upload(order)
+
+    return order
+
+
 def check_order_statuses_from_retailcrm(orders_retailcrm_ids, retailcrm_client=None,
                                         statuses_codes=None):
     if retailcrm_client is None:
         retailcrm_client = retailcrm.v5(settings.RETAIL_CRM_URL, settings.RETAIL_CRM_API_KEY)
 
-    if statuses_codes is None:
-        statuses_codes = get_order_statuses_codes()
-
     response = retailcrm_client.orders_statuses(ids=list(orders_retailcrm_ids), external_ids=[])
     result = response.get_response()
     print(result)
 
-    for order in result['orders']:
+    apply_retailcrm_statuses(result['orders'], statuses_codes=statuses_codes)
+
+
+def apply_retailcrm_statuses(crm_orders, statuses_codes=None) -> int:
+    """Применяет статусы заказов из RetailCRM: crm_orders - словари с status и externalId или id.
+
+    Заказы выбираются одним запросом, записи OrderStatusLog создаются bulk_create, статус
+    записывается одним bulk_update без пересчета сумм. Возвращает число измененных заказов
+    """
+    if statuses_codes is None:
+        statuses_codes = get_order_statuses_codes()
+
+    changes = []
+    order_ids, retailcrm_ids = set(), set()
+    for order in crm_orders:
         if order['status'] not in statuses_codes:
             print(
-                f'Continue, status {order["status"]} was not found for order {order["externalId"]}'
+                f'Continue, status {order["status"]} was not found for order {order.get("externalId")}'
             )
             continue
 
-        status = statuses_codes[order['status']]
-
         try:
             if 'externalId' in order:
-                order_obj = models.Order.objects.get(pk=int(order['externalId']))
+                key = ('id', int(order['externalId']))
+                order_ids.add(key[1])
             elif 'id' in order:
-                order_obj = models.Order.objects.get(retailcrm_id=int(order['id']))
-        except (models.Order.DoesNotExist, ValueError):
+                key = ('retailcrm_id', int(order['id']))
+                retailcrm_ids.add(key[1])
+            else:
+                continue
+        except ValueError:
             continue
 
-        if order_obj.status_id != status.id:
-            models.OrderStatusLog.objects.create(order=order_obj, status=status, send_email=True)
-            print(f'Order {order_obj}: {status}')
+        changes.append((key, statuses_codes[order['status']]))
+
+    if not changes:
+        return 0
+
+    orders = {}
+    for order_obj in models.Order.objects.filter(
+        Q(pk__in=order_ids) | Q(retailcrm_id__in=retailcrm_ids)
+    ).only('id', 'retailcrm_id', 'status', 'user', 'order_number'):
+        orders[('id', order_obj.pk)] = order_obj
+        if order_obj.retailcrm_id is not None:
+            orders[('retailcrm_id', order_obj.retailcrm_id)] = order_obj
+
+    now = timezone.now()
+    status_logs = []
+    changed_orders = {}
+    for key, status in changes:
+        order_obj = orders.get(key)
+        if order_obj is None or order_obj.status_id == status.id:
+            continue
 
+        order_obj.status = status
+        order_obj.updated = now
+        status_logs.append(models.OrderStatusLog(order=order_obj, status=status, send_email=True))
+        changed_orders[order_obj.pk] = order_obj
+        print(f'Order {order_obj}: {status}')
 
-def is_free_delivery(items_amount, deivery_region, delivery_type):
-    """Является ли доставка бесплатной по объему покупки (если включен такой режим)"""
+    if changed_orders:
+        with transaction.atomic():
+            models.OrderStatusLog.objects.bulk_create(status_logs)
+            models.Order.objects.bulk_update(changed_orders.values(), ('status', 'updated'))
+        invalidate_order_history(order_obj.user_id for order_obj in changed_orders.values())
+
+    return len(changed_orders)
 
-    if delivery_type.is_price_from:
-        return False
 
-    limit = deivery_region.free_delivery
-    if limit and items_amount >= limit:
-        return True
+class RetailCRMHandbooks:
+    """Справочники для импорта заказов из RetailCRM: типы доставки и оплаты по retail_code
+    загружаются один раз на весь импорт, промокоды - по мере появления в заказах
+    """
 
-    return False
+    def __init__(self):
+        self.delivery_types = {x.retail_code: x for x in DeliveryType.objects.all() if x.retail_code}
+        self.payment_types = {x.retail_code: x for x in PaymentType.objects.all() if x.retail_code}
+        self.coupons = {}
+
+    def load_coupons(self, passphrases) -> None:
+        missing = set(filter(None, passphrases)) - set(self.coupons)
+        if missing:
+            found = {x.passphrase: x for x in Coupon.objects.filter(passphrase__in=missing)}
+            self.coupons.update({passphrase: found.get(passphrase) for passphrase in missing})
+
+
+def get_retailcrm_payment(crm_order, order):
+    """Оплата заказа из RetailCRM (payments - словарь по ID оплаты или список).
+
+    Выбирается оплата с externalId, который get_order_data отправляет из
+    payment_gateway_order_id, иначе первая
+    """
+    payments = crm_order.get('payments') or {}
+    if isinstance(payments, dict):
+        payments = list(payments.values())
+    if not payments:
+        return None
+
+    if order.payment_gateway_order_id:
+        for payment in payments:
+            if str(payment.get('externalId')) == order.payment_gateway_order_id:
+                return payment
+    return payments[0]
+
+
+def apply_retailcrm_orders(crm_orders, handbooks: RetailCRMHandbooks) -> int:
+    """Переносит в заказы тип доставки, оплату и промокод из заказов RetailCRM.
+
+    Заказы страницы выбираются одним запросом (по retailcrm_id или externalId), измененные
+    записываются одним bulk_update. Возвращает число измененных заказов
+    """
+    crm_ids, order_ids = set(), set()
+    for crm_order in crm_orders:
+        if crm_order.get('id'):
+            crm_ids.add(int(crm_order['id']))
+        if str(crm_order.get('externalId', '')).isdigit():
+            order_ids.add(int(crm_order['externalId']))
+
+    orders = list(
+        models.Order.objects.filter(Q(retailcrm_id__in=crm_ids) | Q(pk__in=order_ids))
+        .prefetch_related('items')
+    )
+    by_crm_id = {order.retailcrm_id: order for order in orders if order.retailcrm_id}
+    by_id = {order.pk: order for order in orders}
+
+    handbooks.load_coupons(
+        (crm_order.get('customFields') or {}).get('coupon') for crm_order in crm_orders
+    )
+    coupons = {x for x in handbooks.coupons.values() if x is not None}
+    coupon_entries = {
+        (x.coupon_id, x.order_id): x
+        for x in CouponEntry.objects.filter(order__in=orders, coupon__in=coupons)
+    } if orders and coupons else {}
+
+    now = timezone.now()
+    changed_orders = []
+    for crm_order in crm_orders:
+        order = by_crm_id.get(crm_order.get('id'))
+        if order is None and str(crm_order.get('externalId', '')).isdigit():
+            order = by_id.get(int(crm_order['externalId']))
+        if order is None:
+            continue
+
+        delivery_code = (crm_order.get('delivery') or {}).get('code')
+        if delivery_code:
+            if delivery_code in handbooks.delivery_types:
+                order.delivery_type = handbooks.delivery_types[delivery_code]
+            else:
+                print(f'Order {order}: unknown delivery {delivery_code}')
+
+        payment = get_retailcrm_payment(crm_order, order)
+        if payment:
+            if payment.get('type') in handbooks.payment_types:
+                order.payment_type = handbooks.payment_types[payment['type']]
+                order.payment_status = (
+                    PaymentStatusEnum.PAID if payment.get('status') == 'paid' else PaymentStatusEnum.NOT_PAID
+                )
+            else:
+                print(f'Order {order}: unknown payment type {payment.get("type")}')
+
+        coupon = handbooks.coupons.get((crm_order.get('customFields') or {}).get('coupon'))
+        if coupon is not None:
+            order.coupon = coupon
+            order.coupon_entry = coupon_entries.get((coupon.id, order.id))
+
+        changed_fields = order.get_changed_fields()
+        if not changed_fields:
+            continue
+
+        if 'coupon_id' in changed_fields:
+            order.update_totals(items=list(order.items.all()))
+        elif changed_fields & order.totals_source_fields:
+            order.update_total_amount()
+        order.updated = now
+        changed_orders.append(order)
+
+    models.Order.objects.bulk_update(changed_orders, RETAIL_CRM_IMPORT_FIELDS)
+    invalidate_order_history(order.user_id for order in changed_orders)
+    return len(changed_orders)
+
+
+def get_retailcrm_cursor(name, default=None):
+    cursor = models.RetailCRMCursor.objects.filter(name=name).first()
+    return cursor.value if cursor is not None else default
+
+
+def set_retailcrm_cursor(name, value) -> None:
+    models.RetailCRMCursor.objects.update_or_create(name=name, defaults={'value': str(value)})
+
+
+def sync_order_statuses_from_retailcrm_history(retailcrm_client=None, statuses_codes=None,
+                                               start_date=None, limit=100) -> int:
+    """Применяет смены статусов из ленты orders/history, начиная с сохраненного sinceId.
+
+    Позиция сохраняется после каждой страницы, поэтому прерванный запуск продолжится с нее.
+    Без сохраненной позиции лента читается с start_date (тогда он обязателен).
+    Возвращает число прочитанных записей
+    """
+    since_id = get_retailcrm_cursor(ORDERS_HISTORY_CURSOR)
+    if not since_id and start_date is None:
+        raise ValueError('No saved orders/history position, start_date is required')
+
+    if retailcrm_client is None:
+        retailcrm_client = retailcrm.v5(settings.RETAIL_CRM_URL, settings.RETAIL_CRM_API_KEY)
+
+    processed = 0
+    while True:
+        filters = {'sinceId': since_id} if since_id else {'startDate': start_date.strftime('%Y-%m-%d')}
+        result = retailcrm_client.orders_history(filters=filters, limit=limit).get_response()
+        if not result.get('success'):
+            raise RuntimeError(f'RetailCRM orders/history error: {result}')
+
+        history = result.get('history') or []
+        if not history:
+            break
+
+        # последний статус каждого заказа на странице
+        crm_orders = {}
+        for change in history:
+            if change.get('field') != 'status' or not change.get('newValue'):
+                continue
+            order = change.get('order') or {}
+            crm_order = {'status': change['newValue']['code']}
+            for key in ('id', 'externalId'):
+                if key in order:
+                    crm_order[key] = order[key]
+            crm_orders[order.get('id') or ('externalId', order.get('externalId'))] = crm_order
+
+        with transaction.atomic():
+            apply_retailcrm_statuses(crm_orders.values(), statuses_codes=statuses_codes)
+            since_id = history[-1]['id']
+            set_retailcrm_cursor(ORDERS_HISTORY_CURSOR, since_id)
+
+        processed += len(history)
+        print(f'History processed: {processed}, sinceId: {since_id}')
+        if len(history) < limit:
+            break
+
+    return processed
+
+
+def is_free_delivery(items_amount, deivery_region, delivery_type):
+    """Является ли доставка бесплатной по объему покупки (если включен такой режим)"""
+    return pricing.is_free_delivery(
+        items_amount, deivery_region.free_delivery, is_price_from=delivery_type.is_price_from
+    )
 
 
 def update_payment_status(order: Order):
@@ -232,15 +669,17 @@ def get_address(order):
     return address
 
 
-def update_retail_user(order: Order, client) -> bool:
-    """Обновляет данные пользователя в системе ReatilCRM"""
-    user = order.user
-    address = get_address(order)
+def log_retailcrm(order: Order, text: str) -> None:
+    """Добавляет запись в журнал обмена с RetailCRM по заказу"""
+    models.RetailCRMLog.from_text(order, text).save()
+
+
+def get_retail_customer_profile(user) -> dict:
+    """Данные покупателя без адреса, который берется из каждого заказа"""
     customer_data = {
         "externalId": user.id,
         "firstName": user.first_name,
         "lastName": user.last_name,
-        "address": address,
         "createdAt": timezone.localtime(user.created).strftime("%Y-%m-%d %H:%M:%S"),
         "site": settings.RETAIL_CRM_SITE_CODE,
     }
@@ -248,16 +687,29 @@ def update_retail_user(order: Order, client) -> bool:
     if user.birth_date:
         customer_data["birthday"] = user.birth_date.strftime("%Y-%m-%d")
 
+    return customer_data
+
+
+def get_retail_customer_data(order: Order) -> dict:
+    customer_data = get_retail_customer_profile(order.user)
+    customer_data["address"] = get_address(order)
+    return customer_data
+
+
+def update_retail_user(order: Order, client) -> bool:
+    """Обновляет данные пользователя в системе ReatilCRM"""
+    customer_data = get_retail_customer_data(order)
+
     print("Обновляем пользователя")
     response = client.customer_edit(customer_data, site=settings.RETAIL_CRM_SITE_CODE)
     result = response.get_response()
     print(result)
     if result.get("success") is False:
-        order.retail_crm_log = (
+        log_retailcrm(
+            order,
             f"Отправлено при обновлении пользователя:\n"
             f"{customer_data}\n\nОтвет:\n{result}"
         )
-        order.save()
         return False
 
     return True
@@ -300,8 +752,13 @@ def get_delivery_data(order) -> dict:
 
 
 def get_order_items(order) -> list:
+    if 'items' in getattr(order, '_prefetched_objects_cache', {}):
+        order_items = order.items.all()
+    else:
+        order_items = order.items.select_related('offer').iterator()
+
     items = []
-    for item in order.items.select_related('offer').iterator():
+    for item in order_items:
         item_data = {
             'initialPrice': float(item.price),
             'createdAt': item.created.strftime('%Y-%m-%d %H:%M:%S'),
@@ -405,6 +862,79 @@ def get_order_data(order) -> dict:
     return order_data
 
 
+def get_retail_customer_hash(user) -> str:
+    customer_data = get_retail_customer_profile(user)
+    return hashlib.sha256(json.dumps(customer_data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def save_retail_customer(user_id, profile_hash) -> None:
+    try:
+        with transaction.atomic():
+            models.RetailCRMCustomer.objects.update_or_create(
+                user_id=user_id, defaults={'profile_hash': profile_hash}
+            )
+    except IntegrityError:
+        # покупателя одновременно записал другой поток выгрузки
+        pass
+
+
+def sync_retail_customer(order, retailcrm_client) -> bool:
+    """Создает или дополняет покупателя заказа в RetailCRM, ошибку записывает в лог заказа.
+
+    Покупатель, уже синхронизированный с теми же данными (RetailCRMCustomer), пропускается
+    без запросов к RetailCRM. Хеш сохраняется только после успешного создания или обновления
+    """
+    need_update = False
+    profile_hash = None
+    try:
+        if order.user.id:
+            profile_hash = get_retail_customer_hash(order.user)
+            known = models.RetailCRMCustomer.objects.filter(user_id=order.user_id).first()
+            if known is not None and known.profile_hash == profile_hash:
+                return True
+
+            user = retailcrm_client.customer(uid=order.user.id).get_response()
+            if not user['success']:
+                if not create_retail_user(order.user):
+                    log_retailcrm(order, 'Ошибка создания пользователя в RetailCRM')
+                    return False
+            else:
+                need_update = bool(('firstName' not in user['customer']) or not user['customer']['firstName'])
+
+        if need_update:
+            is_updated = update_retail_user(order, client=retailcrm_client)
+            if not is_updated:
+                log_retailcrm(order, 'Ошибка обновления пользователя в RetailCRM')
+                return False
+    except Exception as e:
+        log_retailcrm(order, f'Ошибка создания или обновления пользователя в RetailCRM: {traceback.format_exc()}')
+        return False
+
+    if profile_hash is not None:
+        save_retail_customer(order.user_id, profile_hash)
+
+    return True
+
+
+def select_retailcrm_related(queryset):
+    """Загружает все, что нужно get_order_data и синхронизации покупателя, фиксированным
+    числом запросов (заказы со связями и один запрос позиций) вместо запросов на каждый заказ
+    """
+    return queryset.select_related(
+        'user', 'region', 'payment_type', 'coupon', 'delivery_point', 'self_delivery_point'
+    ).prefetch_related(
+        Prefetch(
+            'items',
+            queryset=models.OrderItem.objects.select_related('offer__product', 'offer__color_value')
+        )
+    )
+
+
+def get_orders_data(queryset) -> list:
+    """Данные для RetailCRM для всех заказов queryset, см. select_retailcrm_related"""
+    return [get_order_data(order) for order in select_retailcrm_related(queryset)]
+
+
 def upload_order_to_retailcrm(order, retailcrm_client=None):
     print(f'Order {order}... ', end='')
     if retailcrm_client is None:
@@ -414,25 +944,7 @@ def upload_order_to_retailcrm(order, retailcrm_client=None):
         )
 
     with transaction.atomic():
-
-        need_update = False 
-        try:
-            if order.user.id:
-                user = retailcrm_client.customer(uid=order.user.id).get_response()
-                if not user['success']:
-                    create_retail_user(order.user)
-                else:
-                    need_update = bool(('firstName' not in user['customer']) or not user['customer']['firstName'])
-
-            if need_update:
-                is_updated = update_retail_user(order, client=retailcrm_client)
-                if not is_updated:
-                    order.retail_crm_log = 'Ошибка обновления пользователя в RetailCRM'
-                    order.save()
-                    return False
-        except Exception as e:
-            order.retail_crm_log = f'Ошибка создания или обновления пользователя в RetailCRM: {traceback.format_exc()}'
-            order.save()
+        if not sync_retail_customer(order, retailcrm_client):
             return False
 
         order_data = get_order_data(order)
@@ -448,14 +960,147 @@ def upload_order_to_retailcrm(order, retailcrm_client=None):
 
         if result.get('id'):
             order.retailcrm_id = result.get('id')
+            order.save()
 
-        order.retail_crm_log = f'Отправлено:\n{order_data}\n\nОтвет:\n{result}'
-        order.save()
+        log_retailcrm(order, f'Отправлено:\n{order_data}\n\nОтвет:\n{result}')
 
     print('done')
     return bool(result.get('success'))
 
 
+def get_upload_error(result, index):
+    """Ошибка заказа с индексом index из ответа orders/upload (errors - список или словарь)"""
+    errors = result.get('errors')
+    if isinstance(errors, dict):
+        return errors.get(str(index), errors.get(index))
+    if isinstance(errors, list) and index < len(errors):
+        return errors[index]
+    return None
+
+
+def get_uploaded_ids(result, payloads) -> list:
+    """ID в RetailCRM для каждого заказа пачки (None - не выгружен).
+
+    Заказы из uploadedOrders сопоставляются по номеру, если RetailCRM его вернул, иначе по
+    порядку: uploadedOrders идут в порядке пачки без заказов с ошибками
+    """
+    uploaded = result.get('uploadedOrders') or []
+    if all(uploaded_order.get('number') for uploaded_order in uploaded):
+        by_number = {uploaded_order['number']: uploaded_order.get('id') for uploaded_order in uploaded}
+        return [by_number.get(order_data['number']) for order_data in payloads]
+
+    indexes = [
+        index for index in range(len(payloads)) if get_upload_error(result, index) is None
+    ]
+    uploaded_ids = [None] * len(payloads)
+    if len(indexes) == len(uploaded):
+        for index, uploaded_order in zip(indexes, uploaded):
+            uploaded_ids[index] = uploaded_order.get('id')
+    return uploaded_ids
+
+
+def upload_orders_to_retailcrm(orders, retailcrm_client=None) -> dict:
+    """Выгружает пачку заказов (до RETAIL_CRM_UPLOAD_LIMIT) одним запросом orders/upload.
+
+    Покупатели синхронизируются по одному, заказы с ошибкой покупателя в пачку не попадают.
+    Данные заказов те же, что и при выгрузке по одному (без externalId), ID из uploadedOrders
+    сопоставляются с заказами функцией get_uploaded_ids и записываются одним bulk_update,
+    записи журнала - одним bulk_create. Возвращает {заказ: выгружен ли}
+    """
+    if retailcrm_client is None:
+        retailcrm_client = retailcrm.v5(settings.RETAIL_CRM_URL, settings.RETAIL_CRM_API_KEY)
+
+    results = {order: False for order in orders}
+    orders = [order for order in orders if sync_retail_customer(order, retailcrm_client)]
+    if not orders:
+        return results
+
+    payloads = [get_order_data(order) for order in orders]
+
+    print(f'Sending {len(payloads)} orders')
+    result = retailcrm_client.orders_upload(payloads, site=settings.RETAIL_CRM_SITE_CODE).get_response()
+    print('Result\n', result)
+
+    uploaded_ids = get_uploaded_ids(result, payloads)
+
+    now = timezone.now()
+    logs = []
+    for index, (order, order_data) in enumerate(zip(orders, payloads)):
+        retailcrm_id = uploaded_ids[index]
+        if retailcrm_id:
+            order.retailcrm_id = retailcrm_id
+            order_result = {'success': True, 'id': retailcrm_id}
+        else:
+            order_result = {
+                'success': False,
+                'errorMsg': result.get('errorMsg'),
+                'error': get_upload_error(result, index)
+            }
+        logs.append(
+            models.RetailCRMLog.from_text(order, f'Отправлено:\n{order_data}\n\nОтвет:\n{order_result}')
+        )
+        order.updated = now
+        results[order] = bool(retailcrm_id)
+
+    with transaction.atomic():
+        models.RetailCRMLog.objects.bulk_create(logs)
+        models.Order.objects.bulk_update(
+            [order for order in orders if results[order]], ('retailcrm_id', 'updated')
+        )
+    return results
+
+
+def enqueue_retailcrm_upload(order: Order) -> None:
+    """Ставит заказ в очередь выгрузки в RetailCRM, если его нужно выгружать"""
+    if order.is_retailcrm_upload_needed():
+        models.RetailCRMOrderSync.objects.get_or_create(order=order)
+
+
+def get_orders_for_retailcrm_upload():
+    """Заказы, которым подошло время выгрузки в RetailCRM (по индексу очереди RetailCRMOrderSync).
+
+    Очередь - единственный источник заказов для выгрузки: ожидающие записи заказов, которые
+    уже получили retailcrm_id или не выгружаются по номеру, закрываются, а не выбираются снова
+    """
+    excluded = Q()
+    for prefix in Order.retailcrm_excluded_prefixes:
+        excluded |= Q(order__order_number__startswith=prefix)
+
+    models.RetailCRMOrderSync.objects.filter(
+        status=RetailCRMSyncStatusEnum.PENDING
+    ).filter(
+        excluded | Q(order__retailcrm_id__isnull=False)
+    ).update(status=RetailCRMSyncStatusEnum.UPLOADED, updated=timezone.now())
+
+    return models.Order.objects.filter(
+        retailcrm_sync__status=RetailCRMSyncStatusEnum.PENDING,
+        retailcrm_sync__next_attempt__lte=timezone.now(),
+    ).select_related('retailcrm_sync').order_by('retailcrm_sync__next_attempt')
+
+
+def record_retailcrm_upload(results: dict) -> None:
+    """Записывает в очередь результаты выгрузки {заказ: выгружен ли}.
+
+    Неудачная попытка откладывает следующую с удвоением задержки, после
+    RETAIL_CRM_MAX_ATTEMPTS попыток заказ переходит в DEAD
+    """
+    now = timezone.now()
+    syncs = []
+    for order, success in results.items():
+        sync = order.retailcrm_sync
+        sync.attempts += 1
+        if success:
+            sync.status = RetailCRMSyncStatusEnum.UPLOADED
+        elif sync.attempts >= RETAIL_CRM_MAX_ATTEMPTS:
+            sync.status = RetailCRMSyncStatusEnum.DEAD
+        else:
+            sync.next_attempt = now + RETAIL_CRM_RETRY_DELAY * 2 ** (sync.attempts - 1)
+        sync.updated = now
+        syncs.append(sync)
+
+    models.RetailCRMOrderSync.objects.bulk_update(syncs, ('attempts', 'next_attempt', 'status', 'updated'))
+
+
 def update_user_data(user, order: Order) -> None:
 
     if not user.first_name:
@@ -489,3 +1134,142 @@ def update_user_address_data(user, order: Order) -> None:
     user_address.apartment = order.apartment
     user_address.comment = order.comment
     user_address.save()
+
+
+def enqueue_order_notifications(order: Order, kinds, request=None) -> list:
+    """Записывает уведомления по заказу в очередь (в текущей транзакции).
+
+    Из request сохраняются заголовки NOTIFICATION_REQUEST_META, письмо менеджерам отправляется
+    воркером с запросом, восстановленным из них
+    """
+    request_meta = None
+    if request is not None:
+        request_meta = {key: request.META[key] for key in NOTIFICATION_REQUEST_META if key in request.META}
+
+    return models.OrderNotification.objects.bulk_create([
+        models.OrderNotification(order=order, kind=kind, request_meta=request_meta) for kind in kinds
+    ])
+
+
+def get_notification_request(notification):
+    """Запрос оформления заказа, восстановленный из сохраненных заголовков"""
+    if notification.request_meta is None:
+        return None
+
+    request = HttpRequest()
+    request.META.update(notification.request_meta)
+    request.path = request.path_info = request.META.get('PATH_INFO', '')
+    return request
+
+
+def send_order_notification(notification, config, socials) -> None:
+    """Отправляет уведомление, при ошибке отправки выбрасывает исключение"""
+    order = notification.order
+    order_items = list(order.items.all())
+
+    if notification.kind == OrderNotificationKindEnum.ORDER_CUSTOMER:
+        send_email(
+            'order_customer',
+            [order.email],
+            'Заказ №%s на сайте %s успешно оформлен' % (order.order_number, settings.SITE_NAME),
+            params={
+                'order': order,
+                'order_items': order_items,
+                'site_name': settings.SITE_NAME,
+                'media_url': settings.MEDIA_URL,
+                'site_url': settings.SITE_URL,
+                'config': config,
+            },
+            raise_error=True
+        )
+
+    elif notification.kind == OrderNotificationKindEnum.FAST_ORDER_CUSTOMER:
+        send_email(
+            'fast_order_customer',
+            [order.email],
+            'Быстрый заказ №%s на сайте %s успешно оформлен' % (
+                order.order_number, settings.SITE_NAME
+            ),
+            params={
+                'order': order,
+                'order_items': order_items,
+                'config': config,
+                'socials': socials
+            },
+            raise_error=True
+        )
+
+    elif notification.kind == OrderNotificationKindEnum.FAST_ORDER_TRIGGER:
+        send_trigger_email(
+            'Новый быстрый заказ №%s' % order.order_number,
+            request=get_notification_request(notification), obj=order,
+            fields=order.fast_order_email_fields, raise_error=True
+        )
+
+
+def claim_order_notifications(batch_size) -> list:
+    """Забирает пачку уведомлений, которым подошло время отправки.
+
+    Строки блокируются с SKIP LOCKED, поэтому несколько воркеров не возьмут одно уведомление.
+    В короткой транзакции увеличивается attempts и next_attempt переносится на
+    NOTIFICATION_LEASE вперед: если воркер упадет во время отправки, уведомление снова
+    станет доступным после окончания аренды
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        notifications = list(
+            models.OrderNotification.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(status=OrderNotificationStatusEnum.NEW, next_attempt__lte=now)
+            .select_related('order')
+            .order_by('next_attempt')[:batch_size]
+        )
+        if notifications:
+            models.OrderNotification.objects.filter(
+                id__in=[notification.id for notification in notifications]
+            ).update(attempts=F('attempts') + 1, next_attempt=now + NOTIFICATION_LEASE, updated=now)
+
+    for notification in notifications:
+        notification.attempts += 1
+        notification.next_attempt = now + NOTIFICATION_LEASE
+    return notifications
+
+
+def send_order_notifications(batch_size=100) -> tuple:
+    """Отправляет пачку уведомлений, которым подошло время отправки.
+
+    Письма отправляются вне транзакции, результат каждого сохраняется сразу после отправки.
+    Неудачная отправка повторяется с растущей задержкой, после NOTIFICATION_MAX_ATTEMPTS
+    попыток уведомление помечается как неотправленное.
+    Возвращает количество отправленных и неотправленных уведомлений
+    """
+    sent_count = failed_count = 0
+
+    notifications = claim_order_notifications(batch_size)
+    if not notifications:
+        return sent_count, failed_count
+
+    config = SiteConfig.get_solo()
+    socials = list(
+        MenuItem.objects.published()
+        .filter(menu__slug='SOCIALS', menu__status=StatusEnum.PUBLIC)
+    )
+
+    for notification in notifications:
+        try:
+            send_order_notification(notification, config, socials)
+        except Exception:
+            notification.error = traceback.format_exc()
+            if notification.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                notification.status = OrderNotificationStatusEnum.FAILED
+            else:
+                notification.next_attempt = timezone.now() \
+                    + NOTIFICATION_RETRY_DELAY * 2 ** (notification.attempts - 1)
+            failed_count += 1
+        else:
+            notification.status = OrderNotificationStatusEnum.SENT
+            notification.error = None
+            sent_count += 1
+
+        notification.save(update_fields=('error', 'next_attempt', 'status', 'updated'))
+
+    return sent_count, failed_count
@@ -30,6 +30,11 @@ urlpatterns = (
         views.OrderFastView.as_view(),
         name='order_fast'
     ),
+    path(
+        'metrics/',
+        views.OrderMetricsView.as_view(),
+        name='order_metrics'
+    ),
     path(
         'history/',
         include(router.urls)
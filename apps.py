@@ -4,3 +4,8 @@ from django.apps import AppConfig as BaseAppConfig
 class AppConfig(BaseAppConfig):
     name = 'orders'
     verbose_name = 'Заказы'
+
+    def ready(self):
+        from orders.cache import connect_signals
+
+        connect_signals()
@@ -0,0 +1,324 @@
+import hashlib
+import threading
+import uuid
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from carts.models import Cart, CartItem
+from coupons.models import Coupon, CouponEntry
+from handbooks.models import DeliveryRegion, DeliveryType, OrderStatus, PaymentType, Region
+from orders.models import Order
+
+CALC_PRICE_CACHE_TIMEOUT = 5 * 60
+CART_ID_CACHE_TIMEOUT = 24 * 60 * 60
+CART_ID_KEY = 'orders:cart-id:%s'
+CART_VERSION_KEY = 'orders:cart-version:%s'
+# версия удаленной корзины: владельцу нужно заново найти свою корзину
+CART_DELETED = 'deleted'
+COUPON_VERSION_KEY = 'orders:coupon-version:%s'
+ORDER_HISTORY_CACHE_TIMEOUT = 60 * 60
+ORDER_HISTORY_VERSION_KEY = 'orders:history-version:%s'
+
+
+def get_versions(keys) -> list:
+    """Версии по ключам одним запросом к кешу, отсутствующие версии создаются"""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if versions.get(key) is None:
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+
+    return [versions[key] for key in keys]
+
+
+class HandbookCache:
+    """Кеш справочников в памяти процесса.
+
+    Таблица справочника загружается целиком при первом обращении и перечитывается, когда
+    меняется версия модели в общем кеше Django. Версию меняют сигналы post_save/post_delete
+    после фиксации транзакции, поэтому для сброса кеша во всех процессах нужен общий бэкенд
+    кеша (redis, memcached)
+    """
+
+    version_key = 'orders:handbook-version:%s'
+
+    def __init__(self):
+        self.stats = Counter()
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get_version(self, model):
+        return self.get_versions([model])[0]
+
+    def get_versions(self, models) -> list:
+        """Версии моделей одним запросом к кешу"""
+        return get_versions(self.get_version_keys(models))
+
+    def get_version_keys(self, models) -> list:
+        return [self.version_key % model._meta.label_lower for model in models]
+
+    def invalidate(self, model):
+        cache.set(self.version_key % model._meta.label_lower, uuid.uuid4().hex, None)
+
+    def get_table(self, model, name, loader):
+        """Таблица справочника name, построенная функцией loader"""
+        version = self.get_version(model)
+        key = (model._meta.label_lower, name)
+
+        cached = self._tables.get(key)
+        if version is not None and cached is not None and cached[0] == version:
+            self.stats['hits'] += 1
+            return cached[1]
+
+        self.stats['misses'] += 1
+        table = loader()
+        with self._lock:
+            self._tables[key] = (version, table)
+
+        return table
+
+    def get_stats(self) -> dict:
+        return dict(self.stats)
+
+
+class SingleFlight:
+    """Объединяет одновременные вычисления с одинаковым ключом в одно.
+
+    Работает только в пределах процесса: воркеры gunicorn/uwsgi с одинаковым ключом
+    все равно вычисляют каждый свое значение
+    """
+
+    class Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self.Call()
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+
+handbooks_cache = HandbookCache()
+calc_price_flight = SingleFlight()
+
+HANDBOOK_MODELS = (DeliveryRegion, DeliveryType, OrderStatus, PaymentType, Region)
+# версии этих моделей входят в ключ кеша расчета стоимости, кроме них в ключ входят версии
+# корзины и использований промокода (get_calc_price_versions)
+CALC_PRICE_MODELS = (Coupon, DeliveryType, PaymentType, Region)
+
+
+def get_delivery_type(pk):
+    """Опубликованный способ доставки"""
+    return handbooks_cache.get_table(
+        DeliveryType, 'published',
+        lambda: {x.pk: x for x in DeliveryType.objects.published()}
+    ).get(pk)
+
+
+def get_payment_type(pk):
+    """Опубликованный способ оплаты"""
+    return handbooks_cache.get_table(
+        PaymentType, 'published',
+        lambda: {x.pk: x for x in PaymentType.objects.published()}
+    ).get(pk)
+
+
+def get_region(pk, published=True):
+    if published:
+        return handbooks_cache.get_table(
+            Region, 'published',
+            lambda: {x.pk: x for x in Region.objects.published()}
+        ).get(pk)
+
+    return handbooks_cache.get_table(
+        Region, 'all',
+        lambda: {x.pk: x for x in Region.objects.all()}
+    ).get(pk)
+
+
+def get_default_order_status():
+    """Статус по умолчанию для новых заказов"""
+    return handbooks_cache.get_table(
+        OrderStatus, 'default',
+        lambda: {'default': OrderStatus.objects.filter(is_default=True).first()}
+    )['default']
+
+
+def load_delivery_regions():
+    delivery_regions = {}
+    for delivery_region in DeliveryRegion.objects.published():
+        key = (delivery_region.delivery_type_id, delivery_region.region_id)
+        # несколько опубликованных записей на пару считаются ошибкой настройки
+        delivery_regions[key] = None if key in delivery_regions else delivery_region
+
+    return delivery_regions
+
+
+def get_delivery_region(delivery_type, region):
+    """Опубликованная стоимость доставки в регион"""
+    return handbooks_cache.get_table(
+        DeliveryRegion, 'published', load_delivery_regions
+    ).get((delivery_type.pk, getattr(region, 'pk', region)))
+
+
+def get_coupon_version_key(passphrase) -> str:
+    return COUPON_VERSION_KEY % hashlib.md5(passphrase.strip().lower().encode()).hexdigest()
+
+
+def get_calc_price_versions(cart_id, passphrase=None):
+    """Версии справочников, корзины и использований промокода одним запросом к кешу.
+
+    None - корзина удалена
+    """
+    keys = handbooks_cache.get_version_keys(CALC_PRICE_MODELS) + [CART_VERSION_KEY % cart_id]
+    if passphrase:
+        keys.append(get_coupon_version_key(passphrase))
+
+    versions = get_versions(keys)
+    if CART_DELETED in versions:
+        return None
+    return ':'.join(str(version) for version in versions)
+
+
+def get_cached_cart_id(owner):
+    """ID корзины владельца (пользователя или сессии), запомненный при расчете стоимости"""
+    return cache.get(CART_ID_KEY % owner)
+
+
+def set_cached_cart_id(owner, cart_id) -> None:
+    cache.set(CART_ID_KEY % owner, cart_id, CART_ID_CACHE_TIMEOUT)
+
+
+def invalidate_cart(cart_id, version=None) -> None:
+    """Меняет версию корзины после фиксации транзакции (для изменений без сигналов)"""
+    transaction.on_commit(
+        lambda: cache.set(CART_VERSION_KEY % cart_id, version or uuid.uuid4().hex, None)
+    )
+
+
+def memoize_calc_price(key, compute):
+    """Результат расчета стоимости из кеша, иначе compute() (одно вычисление на ключ).
+
+    compute возвращает пару (результат, ошибки), в кеш попадают только успешные расчеты,
+    при key=None результат не кешируется
+    """
+    if key is None:
+        return compute()
+
+    result = cache.get(key)
+    if result is not None:
+        handbooks_cache.stats['calc_price_hits'] += 1
+        return result, None
+
+    def compute_and_store():
+        handbooks_cache.stats['calc_price_misses'] += 1
+        result, errors = compute()
+        if errors is None:
+            cache.set(key, result, CALC_PRICE_CACHE_TIMEOUT)
+        return result, errors
+
+    return calc_price_flight.do(key, compute_and_store)
+
+
+def get_order_history_version(user_id) -> str:
+    """Версия истории заказов пользователя, меняется при любой записи в его заказы"""
+    key = ORDER_HISTORY_VERSION_KEY % user_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+
+    return version
+
+
+def invalidate_order_history(user_ids) -> None:
+    user_ids = {x for x in user_ids if x}
+    if user_ids:
+        cache.set_many(
+            {ORDER_HISTORY_VERSION_KEY % user_id: uuid.uuid4().hex for user_id in user_ids}, None
+        )
+
+
+def get_cached_order_history(key):
+    return cache.get(key)
+
+
+def set_cached_order_history(key, data) -> None:
+    cache.set(key, data, ORDER_HISTORY_CACHE_TIMEOUT)
+
+
+def invalidate_handbook(sender, **kwargs):
+    # до фиксации транзакции другой процесс перечитал бы старые строки под новой версией
+    transaction.on_commit(lambda: handbooks_cache.invalidate(sender))
+
+
+def invalidate_cart_by_item(sender, instance, **kwargs):
+    invalidate_cart(instance.cart_id)
+
+
+def invalidate_deleted_cart(sender, instance, **kwargs):
+    invalidate_cart(instance.pk, CART_DELETED)
+
+
+def invalidate_coupon_usage(sender, instance, **kwargs):
+    if instance.coupon_id is None:
+        return
+
+    key = get_coupon_version_key(instance.coupon.passphrase)
+    transaction.on_commit(lambda: cache.set(key, uuid.uuid4().hex, None))
+
+
+def invalidate_order_history_by_order(sender, instance, **kwargs):
+    invalidate_order_history([instance.user_id, instance.get_loaded_value('user_id')])
+
+
+def connect_signals():
+    for model in {*HANDBOOK_MODELS, *CALC_PRICE_MODELS}:
+        dispatch_uid = f'orders_handbook_cache_{model._meta.label_lower}'
+        post_save.connect(invalidate_handbook, sender=model, dispatch_uid=dispatch_uid)
+        post_delete.connect(invalidate_handbook, sender=model, dispatch_uid=dispatch_uid)
+
+    dispatch_uid = 'orders_calc_price_cart_item'
+    post_save.connect(invalidate_cart_by_item, sender=CartItem, dispatch_uid=dispatch_uid)
+    post_delete.connect(invalidate_cart_by_item, sender=CartItem, dispatch_uid=dispatch_uid)
+    post_delete.connect(invalidate_deleted_cart, sender=Cart, dispatch_uid='orders_calc_price_cart')
+
+    dispatch_uid = 'orders_calc_price_coupon_entry'
+    post_save.connect(invalidate_coupon_usage, sender=CouponEntry, dispatch_uid=dispatch_uid)
+    post_delete.connect(invalidate_coupon_usage, sender=CouponEntry, dispatch_uid=dispatch_uid)
+
+    # позиции и статусы заказа меняют историю через сохранение заказа (apply_items_change,
+    # OrderStatusLog.save), поэтому сигналов на них нет: по сигналу на каждую удаляемую
+    # позицию было бы по запросу и каскадное удаление не могло бы идти одним DELETE
+    dispatch_uid = 'orders_history_cache_order'
+    post_save.connect(invalidate_order_history_by_order, sender=Order, dispatch_uid=dispatch_uid)
+    post_delete.connect(invalidate_order_history_by_order, sender=Order, dispatch_uid=dispatch_uid)
@@ -0,0 +1,186 @@
+import queue
+import threading
+import time
+import traceback
+
+import retailcrm
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import connection
+
+RETAIL_CRM_RATE_LIMIT = 10
+
+
+class TokenBucket:
+    """Ограничение частоты запросов, общее для всех потоков.
+
+    В корзине не больше capacity токенов, пополняется со скоростью rate токенов в секунду.
+    acquire() ждет, пока токен не появится
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Берет токен и возвращает 0 или, если токена нет, сколько секунд ждать"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class RateLimitedClient:
+    """Клиент RetailCRM, который перед каждым запросом берет токен из лимитера"""
+
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._limiter.acquire()
+            return attr(*args, **kwargs)
+
+        return call
+
+
+def get_retailcrm_client():
+    return retailcrm.v5(settings.RETAIL_CRM_URL, settings.RETAIL_CRM_API_KEY)
+
+
+def import_crm_async():
+    """Модуль асинхронного клиента для команд с --async.
+
+    httpx нужен только ему и в зависимостях проекта не объявлен, поэтому без httpx
+    команда завершается понятной ошибкой, а не ImportError посреди выгрузки
+    """
+    try:
+        from . import crm_async
+    except ImportError as error:
+        raise CommandError(f'--async requires httpx (pip install httpx): {error}') from error
+    return crm_async
+
+
+def get_rate_limit():
+    """Допустимое число запросов в секунду к API RetailCRM"""
+    return getattr(settings, 'RETAIL_CRM_RATE_LIMIT', RETAIL_CRM_RATE_LIMIT)
+
+
+class UploadStats:
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, results):
+        with self._lock:
+            for success in results:
+                if success:
+                    self.succeeded += 1
+                else:
+                    self.failed += 1
+
+    @property
+    def total(self):
+        return self.succeeded + self.failed
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        return self.total / self.elapsed if self.elapsed else 0
+
+    def __str__(self):
+        return (
+            f'{self.total} orders in {self.elapsed:.1f}s ({self.rate:.1f} orders/s), '
+            f'succeeded: {self.succeeded}, failed: {self.failed}'
+        )
+
+
+def run_pool(objects, handle, workers=1, rate=None, client=None):
+    """Обрабатывает objects в workers потоках: handle(obj, client) -> bool,
+    для пачки заказов (obj - список) -> список bool.
+
+    Каждый поток получает свой клиент RetailCRM и свое соединение с БД, запросы всех
+    потоков проходят через общий лимитер rate запросов в секунду. Вместо этого можно
+    передать общий потокобезопасный client со своим лимитом (crm_async.BlockingClient).
+    Исключение в handle считается неудачей и не останавливает остальные
+    """
+    limiter = TokenBucket(rate or get_rate_limit())
+    stats = UploadStats()
+
+    def get_client():
+        return client if client is not None else RateLimitedClient(get_retailcrm_client(), limiter)
+
+    def process(obj, client):
+        try:
+            results = handle(obj, client)
+        except Exception:
+            print(f'{obj}: {traceback.format_exc()}')
+            results = [False] * len(obj) if isinstance(obj, list) else False
+        stats.add(results if isinstance(obj, list) else [results])
+
+    if workers <= 1:
+        worker_client = get_client()
+        for obj in objects:
+            process(obj, worker_client)
+        return stats
+
+    tasks = queue.Queue(maxsize=workers * 2)
+
+    def worker():
+        worker_client = get_client()
+        try:
+            while True:
+                obj = tasks.get()
+                if obj is None:
+                    return
+                process(obj, worker_client)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    for obj in objects:
+        tasks.put(obj)
+    for _ in threads:
+        tasks.put(None)
+    for thread in threads:
+        thread.join()
+
+    return stats
+
+
+def chunked(objects, size):
+    chunk = []
+    for obj in objects:
+        chunk.append(obj)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import threading
+
+import httpx
+from django.conf import settings
+
+from orders.crm import TokenBucket, get_rate_limit
+
+RETAIL_CRM_CONCURRENCY = 10
+RETAIL_CRM_TIMEOUT = 30
+
+
+class Response:
+    """Ответ в интерфейсе retailcrm.v5: get_response() возвращает разобранный JSON"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def get_response(self):
+        return self.data
+
+
+def get_filter_params(filters):
+    params = []
+    for key, value in (filters or {}).items():
+        if isinstance(value, (list, tuple)):
+            params += [(f'filter[{key}][]', item) for item in value]
+        else:
+            params.append((f'filter[{key}]', value))
+    return params
+
+
+class AsyncRetailCRMClient:
+    """Асинхронный клиент API v5 RetailCRM для методов, которые используют заказы.
+
+    Соединения держатся в общем пуле (keep-alive), одновременно выполняется не больше
+    concurrency запросов, частота запросов ограничена rate в секунду
+    """
+
+    def __init__(self, url=None, api_key=None, concurrency=None, timeout=None, rate=None):
+        concurrency = concurrency or RETAIL_CRM_CONCURRENCY
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = TokenBucket(rate or get_rate_limit())
+        self.client = httpx.AsyncClient(
+            base_url=f'{(url or settings.RETAIL_CRM_URL).rstrip("/")}/api/v5',
+            headers={'X-API-KEY': api_key or settings.RETAIL_CRM_API_KEY},
+            timeout=timeout or RETAIL_CRM_TIMEOUT,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def request(self, method, path, params=None, data=None):
+        async with self.semaphore:
+            while True:
+                wait = self.limiter.try_acquire()
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+
+            response = await self.client.request(method, path, params=params, data=data)
+
+        return response.json()
+
+    async def customer(self, uid, uid_type='externalId', site=None):
+        params = {'by': uid_type}
+        if site:
+            params['site'] = site
+        return await self.request('GET', f'/customers/{uid}', params=params)
+
+    async def customer_edit(self, customer, uid_type='externalId', site=None):
+        data = {'customer': json.dumps(customer), 'by': uid_type}
+        if site:
+            data['site'] = site
+        return await self.request('POST', f'/customers/{customer[uid_type]}/edit', data=data)
+
+    async def order_create(self, order, site=None):
+        data = {'order': json.dumps(order)}
+        if site:
+            data['site'] = site
+        return await self.request('POST', '/orders/create', data=data)
+
+    async def orders_upload(self, orders, site=None):
+        data = {'orders': json.dumps(orders)}
+        if site:
+            data['site'] = site
+        return await self.request('POST', '/orders/upload', data=data)
+
+    async def orders_statuses(self, ids=None, external_ids=None):
+        params = [('ids[]', pk) for pk in ids or ()]
+        params += [('externalIds[]', pk) for pk in external_ids or ()]
+        return await self.request('GET', '/orders/statuses', params=params)
+
+    async def orders(self, filters=None, limit=20, page=1):
+        params = [('limit', limit), ('page', page), *get_filter_params(filters)]
+        return await self.request('GET', '/orders', params=params)
+
+    async def orders_history(self, filters=None, limit=100, page=1):
+        params = [('limit', limit), ('page', page), *get_filter_params(filters)]
+        return await self.request('GET', '/orders/history', params=params)
+
+
+class BlockingClient:
+    """Синхронный интерфейс retailcrm.v5 поверх AsyncRetailCRMClient.
+
+    Цикл событий работает в отдельном потоке, запросы из всех потоков выгрузки идут через
+    него и общий пул соединений. Методы возвращают объект с get_response(), поэтому клиент
+    можно передавать в функции api.service вместо retailcrm.v5
+    """
+
+    def __init__(self, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = self.call(self.create_client(kwargs))
+
+    @staticmethod
+    async def create_client(kwargs):
+        return AsyncRetailCRMClient(**kwargs)
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            return Response(self.call(method(*args, **kwargs)))
+
+        return call
+
+    def close(self):
+        self.call(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+async def fetch_order_statuses(pages, **kwargs) -> list:
+    """Ответы orders/statuses для всех страниц ID заказов, страницы запрашиваются одновременно"""
+    async with AsyncRetailCRMClient(**kwargs) as client:
+        return await asyncio.gather(*(client.orders_statuses(ids=list(page)) for page in pages))
@@ -27,3 +27,49 @@ class OrderDeliveryStatusEnum(BaseEnumerate):
     ))
 
     default = NEW_DELIVERY
+
+
+class OrderNotificationKindEnum(BaseEnumerate):
+    """Тип уведомления по заказу"""
+
+    ORDER_CUSTOMER = 'order_customer'
+    FAST_ORDER_CUSTOMER = 'fast_order_customer'
+    FAST_ORDER_TRIGGER = 'fast_order_trigger'
+
+    values = OrderedDict((
+        (ORDER_CUSTOMER, 'Покупателю о заказе'),
+        (FAST_ORDER_CUSTOMER, 'Покупателю о быстром заказе'),
+        (FAST_ORDER_TRIGGER, 'Менеджерам о быстром заказе')
+    ))
+
+
+class OrderNotificationStatusEnum(BaseEnumerate):
+    """Статус отправки уведомления"""
+
+    NEW = 'new'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    values = OrderedDict((
+        (NEW, 'Ожидает отправки'),
+        (SENT, 'Отправлено'),
+        (FAILED, 'Не удалось отправить')
+    ))
+
+    default = NEW
+
+
+class RetailCRMSyncStatusEnum(BaseEnumerate):
+    """Статус выгрузки заказа в RetailCRM"""
+
+    PENDING = 'pending'
+    UPLOADED = 'uploaded'
+    DEAD = 'dead'
+
+    values = OrderedDict((
+        (PENDING, 'Ожидает выгрузки'),
+        (UPLOADED, 'Выгружен'),
+        (DEAD, 'Не удалось выгрузить')
+    ))
+
+    default = PENDING
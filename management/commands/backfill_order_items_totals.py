@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from ...cache import invalidate_order_history
+from ...models import Order, OrderItem
+
+
+class Command(BaseCommand):
+    """Заполняем количество позиций и товаров в заказах"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_pk = 0
+        updated_count = 0
+
+        while True:
+            order_users = dict(
+                Order.objects.filter(pk__gt=last_pk).order_by('pk')
+                .values_list('pk', 'user_id')[:chunk_size]
+            )
+            if not order_users:
+                break
+            order_ids = list(order_users)
+
+            items_totals = {
+                row['order_id']: row for row in OrderItem.objects.filter(
+                    order_id__in=order_ids
+                ).values('order_id').annotate(
+                    items_count=Count('id'), total_quantity=Sum('quantity')
+                ).order_by()
+            }
+
+            orders = []
+            for order_id in order_ids:
+                row = items_totals.get(order_id, {})
+                orders.append(Order(
+                    pk=order_id,
+                    items_count=row.get('items_count') or 0,
+                    total_quantity=row.get('total_quantity') or 0
+                ))
+            Order.objects.bulk_update(orders, ('items_count', 'total_quantity'))
+            invalidate_order_history(order_users.values())
+
+            updated_count += len(orders)
+            last_pk = order_ids[-1]
+            print(f'Updated orders: {updated_count} (last id {last_pk})')
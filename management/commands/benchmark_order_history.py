@@ -0,0 +1,89 @@
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from ...api.serializers import OrderHistoryListRenderer, OrderHistorySerializer
+from ...api.views import OrderHistoryView
+from ...models import Order
+
+
+class Command(BaseCommand):
+    """Сравнение сборки истории заказов сериализаторами и через values()-выборку.
+
+    Берет последние N заказов пользователя, проверяет, что оба способа дают одинаковый JSON
+    с контекстом сериализатора OrderHistoryView, и печатает лучшее время и число запросов
+    для каждого N
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('user', type=int, help='ID пользователя с заказами')
+        parser.add_argument('--sizes', default='10,100,1000', help='Число заказов через запятую')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--host', default=None, help='Хост запроса, по умолчанию из ALLOWED_HOSTS')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(pk=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'User {options["user"]} not found')
+
+        total = Order.objects.filter(user=user).count()
+        renderer = JSONRenderer()
+        context = self.get_serializer_context(user, options['host'])
+
+        for size in (int(size) for size in options['sizes'].split(',')):
+            if size > total:
+                print(f'{size} orders: skipped, user has only {total}')
+                continue
+
+            def serialize():
+                orders = Order.objects.get_list(user=user)[:size]
+                return OrderHistorySerializer(orders, many=True, context=context).data
+
+            def render():
+                history_renderer = OrderHistoryListRenderer(context)
+                orders = list(Order.objects.get_list_values(user=user, columns=history_renderer.columns)[:size])
+                return history_renderer.render(orders)
+
+            serialized, serializer_time, serializer_queries = self.measure(serialize, options['repeat'])
+            rendered, renderer_time, renderer_queries = self.measure(render, options['repeat'])
+
+            if renderer.render(serialized) != renderer.render(rendered):
+                raise CommandError(f'{size} orders: values() output differs from the serializers')
+
+            print(
+                f'{size} orders: serializers {serializer_time * 1000:.1f} ms / {serializer_queries} queries, '
+                f'values() {renderer_time * 1000:.1f} ms / {renderer_queries} queries, '
+                f'x{serializer_time / renderer_time:.1f}'
+            )
+
+    @staticmethod
+    def get_serializer_context(user, host=None):
+        """Контекст, который OrderHistoryView передает сериализаторам списка"""
+        if host is None:
+            allowed_host = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else '*'
+            host = 'localhost' if allowed_host == '*' else allowed_host.lstrip('.')
+
+        request = Request(RequestFactory().get('/', HTTP_HOST=host))
+        request.user = user
+        view = OrderHistoryView(request=request, format_kwarg=None, action='list', args=(), kwargs={})
+        return view.get_serializer_context()
+
+    @staticmethod
+    def measure(build, repeat):
+        best = None
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                started = perf_counter()
+                data = build()
+                elapsed = perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        return data, best, len(queries)
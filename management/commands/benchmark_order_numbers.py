@@ -0,0 +1,88 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ...models import Order
+from ...utils import FIRST_ORDER, OrderNumberAllocator, generate_order_number_from_orders
+
+
+BENCHMARK_SEQUENCE = 'orders_order_number_benchmark_seq'
+BENCHMARK_TABLE = 'orders_order_number_benchmark'
+
+
+class Command(BaseCommand):
+    """Сравнение стоимости выдачи номера заказа: поиск последнего заказа и последовательность БД.
+
+    Сначала замер на текущей таблице заказов, затем на временной таблице номеров размером
+    --sizes: поиск последнего номера (тот же запрос, что в generate_order_number_from_orders)
+    дорожает с ростом таблицы, выдача из последовательности от размера таблицы не зависит
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100)
+        parser.add_argument('--block-size', type=int, default=1)
+        parser.add_argument(
+            '--sizes', default='1000,10000,100000,1000000', help='Размеры таблицы номеров через запятую'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Последовательности номеров поддерживаются только в PostgreSQL')
+
+        count = options['count']
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE TEMPORARY SEQUENCE {BENCHMARK_SEQUENCE}')
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE {BENCHMARK_TABLE} (order_number varchar(12) NOT NULL UNIQUE)'
+            )
+
+        try:
+            allocator = OrderNumberAllocator(
+                block_size=options['block_size'], sequence=BENCHMARK_SEQUENCE
+            )
+            sequence_title = f'sequence (block {allocator.block_size})'
+
+            print(f'Orders table, {Order.objects.count()} rows, allocations: {count}')
+            self.report('last order lookup', count, self.measure(generate_order_number_from_orders, count))
+            self.report(sequence_title, count, self.measure(allocator.allocate, count))
+
+            filled = 0
+            for size in sizes:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f'INSERT INTO {BENCHMARK_TABLE} SELECT generate_series(%s, %s)::text',
+                        [FIRST_ORDER + filled + 1, FIRST_ORDER + size]
+                    )
+                    cursor.execute(f'ANALYZE {BENCHMARK_TABLE}')
+                filled = max(filled, size)
+
+                print(f'Benchmark table, {filled} rows')
+                self.report('last order lookup', count, self.measure(self.lookup_last_number, count))
+                self.report(sequence_title, count, self.measure(allocator.allocate, count))
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP SEQUENCE IF EXISTS {BENCHMARK_SEQUENCE}')
+                cursor.execute(f'DROP TABLE IF EXISTS {BENCHMARK_TABLE}')
+
+    @staticmethod
+    def lookup_last_number():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT order_number FROM {BENCHMARK_TABLE} '
+                f'ORDER BY length(order_number) DESC, order_number DESC LIMIT 1'
+            )
+            return f'{int(cursor.fetchone()[0]) + 1}'
+
+    @staticmethod
+    def measure(allocate, count):
+        started = perf_counter()
+        for _ in range(count):
+            allocate()
+        return perf_counter() - started
+
+    @staticmethod
+    def report(title, count, elapsed):
+        print(f'  {title}: {elapsed / count * 1000000:.1f} us per number, {count / elapsed:.0f} per second')
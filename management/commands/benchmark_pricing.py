@@ -0,0 +1,56 @@
+import random
+from decimal import Decimal
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...pricing import PricingItem, PricingRules, price_orders
+
+
+class Command(BaseCommand):
+    """Замер скорости пакетного расчета сумм заказов (заказов в секунду)"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument('--items', type=int, default=5, help='Позиций в заказе')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument(
+            '--min-rate', type=float, default=0,
+            help='Завершиться с ошибкой, если скорость ниже (заказов в секунду)'
+        )
+
+    def handle(self, *args, **options):
+        rnd = random.Random(1)
+        orders = [
+            (
+                [
+                    PricingItem(Decimal(rnd.randint(100, 20000)), rnd.randint(1, 3))
+                    for _ in range(options['items'])
+                ],
+                PricingRules(
+                    comission_percent=rnd.choice((0, 0, Decimal('2.5'))),
+                    delivery_amount=Decimal(rnd.choice((0, 300, 500))),
+                    coupon_items_discount=Decimal(rnd.choice((0, 0, 500))),
+                    bonus_amount=Decimal(rnd.choice((0, 0, 100)))
+                )
+            )
+            for _ in range(options['orders'])
+        ]
+
+        best = None
+        for _ in range(options['repeat']):
+            started = perf_counter()
+            price_orders(orders)
+            elapsed = perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        rate = len(orders) / best
+        print(
+            f'Priced {len(orders)} orders x {options["items"]} items: '
+            f'{rate:.0f} orders per second (best of {options["repeat"]})'
+        )
+
+        if rate < options['min_rate']:
+            raise CommandError(
+                f'Pricing is slower than expected: {rate:.0f} < {options["min_rate"]:.0f} orders/s'
+            )
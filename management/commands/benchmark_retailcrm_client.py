@@ -0,0 +1,48 @@
+import asyncio
+from time import perf_counter
+
+import retailcrm
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ... import crm
+
+
+class Command(BaseCommand):
+    """Сравнение блокирующего retailcrm.v5 и асинхронного клиента (запросов в секунду).
+
+    Рассчитана на локальный сервер fake_retailcrm: fake_retailcrm --latency 0.05 и
+    benchmark_retailcrm_client --url http://127.0.0.1:8765
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=None, help='По умолчанию RETAIL_CRM_URL')
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--rate', type=float, default=1000, help='Лимит запросов в секунду')
+
+    def handle(self, *args, **options):
+        url = options['url'] or settings.RETAIL_CRM_URL
+        number = options['requests']
+        crm_async = crm.import_crm_async()
+
+        client = retailcrm.v5(url, settings.RETAIL_CRM_API_KEY)
+        started = perf_counter()
+        for pk in range(number):
+            client.orders_statuses(ids=[pk + 1], external_ids=[]).get_response()
+        blocking_time = perf_counter() - started
+
+        async def run():
+            async with crm_async.AsyncRetailCRMClient(
+                url=url, concurrency=options['concurrency'], rate=options['rate']
+            ) as async_client:
+                await asyncio.gather(*(async_client.orders_statuses(ids=[pk + 1]) for pk in range(number)))
+
+        started = perf_counter()
+        asyncio.run(run())
+        async_time = perf_counter() - started
+
+        print(
+            f'{number} requests: retailcrm.v5 {number / blocking_time:.1f} req/s, '
+            f'async x{options["concurrency"]} {number / async_time:.1f} req/s'
+        )
@@ -0,0 +1,51 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ...api import service
+from ...models import Order
+
+# заказы со связями и позиции с предложениями
+BATCH_QUERIES = 2
+
+
+class Command(BaseCommand):
+    """Сравнение построения данных заказов для RetailCRM по одному и пачкой.
+
+    Проверяет, что оба способа дают одинаковые данные и что пачка строится
+    за BATCH_QUERIES запросов независимо от числа заказов, на реальных заказах. На тестовых
+    данных то же проверяет RetailCRMPayloadsTestCase
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=100, help='Сколько последних заказов взять')
+
+    def handle(self, *args, **options):
+        order_ids = list(Order.objects.order_by('-id').values_list('id', flat=True)[:options['orders']])
+        if not order_ids:
+            raise CommandError('No orders')
+
+        with CaptureQueriesContext(connection) as single_queries:
+            started = perf_counter()
+            single = [
+                service.get_order_data(order) for order in Order.objects.filter(id__in=order_ids).order_by('id')
+            ]
+            single_time = perf_counter() - started
+
+        with CaptureQueriesContext(connection) as batch_queries:
+            started = perf_counter()
+            batch = service.get_orders_data(Order.objects.filter(id__in=order_ids).order_by('id'))
+            batch_time = perf_counter() - started
+
+        if single != batch:
+            raise CommandError('Batch payloads differ from per-order payloads')
+
+        print(
+            f'{len(order_ids)} orders: per-order {single_time * 1000:.1f} ms / {len(single_queries)} queries, '
+            f'batch {batch_time * 1000:.1f} ms / {len(batch_queries)} queries'
+        )
+
+        if len(batch_queries) > BATCH_QUERIES:
+            raise CommandError(f'Batch builder made {len(batch_queries)} queries, expected {BATCH_QUERIES}')
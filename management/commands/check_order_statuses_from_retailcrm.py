@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import math
 from time import sleep
@@ -8,16 +9,49 @@ from django.core.management.base import BaseCommand
 
 from handbooks.api.service import get_order_statuses_codes
 
+from ... import crm
 from ...api import service
 from ...models import Order
 
 
 class Command(BaseCommand):
-    """Обновляем статусы платежей за 24 часа"""
+    """Обновляем статусы заказов из RetailCRM.
+
+    По умолчанию сверяются все незавершенные заказы за 183 дня, с --incremental
+    применяются только изменения из ленты orders/history с прошлого запуска
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Читать ленту изменений orders/history с сохраненной позиции sinceId'
+        )
+        parser.add_argument(
+            '--async', action='store_true',
+            help='Запросы через асинхронный клиент с пулом соединений, страницы статусов - одновременно'
+        )
 
     def handle(self, *args, **options):
         from_dt = datetime.date.today() - datetime.timedelta(days=183)
 
+        if options['incremental']:
+            if options['async']:
+                retailcrm_client = crm.import_crm_async().BlockingClient()
+            else:
+                retailcrm_client = retailcrm.v5(settings.RETAIL_CRM_URL, settings.RETAIL_CRM_API_KEY)
+
+            try:
+                processed = service.sync_order_statuses_from_retailcrm_history(
+                    retailcrm_client=retailcrm_client,
+                    statuses_codes=get_order_statuses_codes(),
+                    start_date=from_dt
+                )
+            finally:
+                if options['async']:
+                    retailcrm_client.close()
+            print(f'Order history changes processed: {processed}')
+            return
+
         orders = Order.objects\
             .filter(retailcrm_id__isnull=False, created__gte=from_dt, status__is_stop=False)\
             .values_list('retailcrm_id', flat=True)
@@ -28,6 +62,17 @@ class Command(BaseCommand):
         count = orders.count()
         limit = 490
         print(f'Checking order statuses from retailcrm: {count}')
+
+        if options['async']:
+            fetch_order_statuses = crm.import_crm_async().fetch_order_statuses
+
+            orders = list(orders)
+            pages = [orders[offset:offset + limit] for offset in range(0, len(orders), limit)]
+            for result in asyncio.run(fetch_order_statuses(pages)):
+                print(result)
+                service.apply_retailcrm_statuses(result['orders'], statuses_codes=statuses_codes)
+            return
+
         for page in range(math.ceil(count / limit)):
             orders_batch = orders[page * limit:(page + 1) * limit]
 
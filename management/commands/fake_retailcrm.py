@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qs, urlparse
+
+from django.core.management.base import BaseCommand
+
+
+class FakeRetailCRM:
+    """Ответы API v5 RetailCRM для методов, которые вызывают команды заказов"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.ids = count(1)
+        self.requests = Counter()
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def handle(self, method, path, params):
+        time.sleep(self.latency)
+        parts = path.strip('/').split('/')[2:]  # без api/v5
+        name = '/'.join('<id>' if part.isdigit() else part for part in parts)
+        with self._lock:
+            self.requests[(method, name)] += 1
+
+        if parts[:1] == ['customers']:
+            if method == 'GET' and len(parts) == 2:
+                customer = {'id': next(self.ids), 'externalId': parts[1], 'firstName': 'Fake'}
+                return {'success': True, 'customer': customer}
+            return {'success': True, 'id': next(self.ids)}
+
+        if parts == ['orders', 'create']:
+            order_id = next(self.ids)
+            return {'success': True, 'id': order_id, 'order': {'id': order_id}}
+
+        if parts == ['orders', 'upload']:
+            orders = json.loads(params.get('orders', '[]'))
+            return {
+                'success': True,
+                'uploadedOrders': [
+                    {'id': next(self.ids), 'externalId': order.get('externalId')} for order in orders
+                ]
+            }
+
+        if parts == ['orders', 'statuses']:
+            return {'success': True, 'orders': []}
+
+        if parts in (['orders'], ['orders', 'history']):
+            key = 'orders' if parts == ['orders'] else 'history'
+            return {
+                'success': True,
+                key: [],
+                'pagination': {'limit': 100, 'totalCount': 0, 'currentPage': 1, 'totalPageCount': 1}
+            }
+
+        return {'success': False, 'errorMsg': f'Unknown method {method} /{"/".join(parts)}'}
+
+    def __str__(self):
+        total = sum(self.requests.values())
+        elapsed = time.monotonic() - self.started
+        lines = [f'{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} requests/s)']
+        lines += [f'  {method} {name}: {number}' for (method, name), number in sorted(self.requests.items())]
+        return '\n'.join(lines)
+
+
+class Command(BaseCommand):
+    """Локальный сервер, имитирующий API RetailCRM, для нагрузочной проверки выгрузки.
+
+    Запуск: fake_retailcrm --port 8765 --latency 0.1, затем RETAIL_CRM_URL=http://127.0.0.1:8765
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0.1, help='Задержка ответа, секунд')
+
+    def handle(self, *args, **options):
+        crm = FakeRetailCRM(latency=options['latency'])
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                self.respond(crm.handle('GET', url.path, flatten(parse_qs(url.query))))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                self.respond(crm.handle('POST', urlparse(self.path).path, flatten(parse_qs(body))))
+
+            def respond(self, data):
+                body = json.dumps(data).encode()
+                self.send_response(200 if data['success'] else 400)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((options['host'], options['port']), Handler)
+        print(f'Fake RetailCRM on http://{options["host"]}:{options["port"]}, latency {options["latency"]}s')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print(crm)
+
+
+def flatten(params):
+    return {key: values[-1] for key, values in params.items()}
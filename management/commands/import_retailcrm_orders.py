@@ -1,51 +1,115 @@
-import retailcrm
-from django.conf import settings
-from django.core.management.base import BaseCommand
+import datetime
+import time
 
-from coupons.models import Coupon, CouponEntry
-from handbooks.models import DeliveryType, PaymentType
-from snippets.enums import PaymentStatusEnum
+from django.core.management.base import BaseCommand, CommandError
 
-from ...models import Order
+from ... import crm
+from ...api import service
+
+IMPORT_CURSOR = 'orders_import'
+IMPORT_HISTORY_CURSOR = 'orders_import_history'
 
 
 class Command(BaseCommand):
-    """Обновляем данные заказов из retail crm"""
+    """Обновляем данные заказов из retail crm.
+
+    Заказы читаются постранично за период создания (--start-date, --end-date) или по ленте
+    изменений orders/history (--history). Позиция сохраняется после каждой страницы:
+    --history всегда продолжает с нее, период - с ключом --resume
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start-date', type=datetime.date.fromisoformat, default=None)
+        parser.add_argument('--end-date', type=datetime.date.fromisoformat, default=None)
+        parser.add_argument('--page-size', type=int, default=100, choices=(20, 50, 100))
+        parser.add_argument('--history', action='store_true', help='Импорт по ленте изменений')
+        parser.add_argument(
+            '--resume', action='store_true', help='Продолжить импорт периода с сохраненной страницы'
+        )
 
     def handle(self, *args, **options):
-        retailcrm_client = retailcrm.v5(settings.RETAIL_CRM_URL, settings.RETAIL_CRM_API_KEY)
-        res = retailcrm_client.orders(limit=100, page=1, filters={'numbers': ['AM3751']})
-        r_orders = res.get_response().get('orders', [])
-        for r_order in r_orders:
-            print(r_order)
-            print(r_order.get('id'))
-            order_obj = Order.objects.filter(retailcrm_id=r_order.get('id')).first()
-
-            if order_obj:
-                if r_order.get('delivery'):
-                    if r_order.get('delivery').get('code'):
-                        print(r_order.get('delivery').get('code'))
-                        delivery_type_obj = DeliveryType.objects.get(
-                            retail_code=r_order.get('delivery').get('code')
-                        )
-                        order_obj.delivery_type = delivery_type_obj
-
-                payments = r_order.get('payments')
-                if payments:
-                    payment = r_order.get('payments').get(order_obj.id)
-                    if payment:
-                        payment_type_obj = PaymentType.objects.get(retail_code=payment.get('type'))
-                        order_obj.payment_type = payment_type_obj
-                        order_obj.payment_status = (
-                            PaymentStatusEnum.PAID
-                            if payment.get('status') == 'paid'
-                            else PaymentStatusEnum.NOT_PAID
-                        )
-
-                custom_fields = r_order.get('customFields')
-
-                if custom_fields.get('coupon'):
-                    coupon_obj = Coupon.objects.get(passphrase=custom_fields.get('coupon'))
-                    coupon_entry = CouponEntry.objects.get(coupon=coupon_obj, order=order_obj)
-                    order_obj.coupon = coupon_obj
-                    order_obj.coupon_entry = coupon_entry
+        self.client = crm.RateLimitedClient(
+            crm.get_retailcrm_client(), crm.TokenBucket(crm.get_rate_limit())
+        )
+        self.handbooks = service.RetailCRMHandbooks()
+        self.started = time.monotonic()
+        self.processed = self.updated = 0
+
+        if options['history']:
+            self.import_history(options)
+        else:
+            self.import_period(options)
+
+        print(f'Done: {self.progress()}')
+
+    def import_period(self, options):
+        start_date = options['start_date'] or datetime.date.today() - datetime.timedelta(days=30)
+        end_date = options['end_date'] or datetime.date.today()
+        filters = {'createdAtFrom': start_date.isoformat(), 'createdAtTo': end_date.isoformat()}
+        period = f'{filters["createdAtFrom"]}|{filters["createdAtTo"]}'
+
+        page = 1
+        if options['resume']:
+            saved_period, _, saved_page = (service.get_retailcrm_cursor(IMPORT_CURSOR) or '').rpartition('|')
+            if saved_period == period:
+                page = int(saved_page) + 1
+
+        while True:
+            result = self.request(
+                self.client.orders, filters=filters, limit=options['page_size'], page=page
+            )
+            total_pages = result.get('pagination', {}).get('totalPageCount', 0)
+            if page > total_pages:
+                break
+
+            self.apply(result.get('orders') or [])
+            service.set_retailcrm_cursor(IMPORT_CURSOR, f'{period}|{page}')
+            print(f'Page {page}/{total_pages}: {self.progress()}')
+            page += 1
+
+    def import_history(self, options):
+        since_id = service.get_retailcrm_cursor(IMPORT_HISTORY_CURSOR)
+        if not since_id and not options['start_date']:
+            raise CommandError('No saved history position, --start-date is required')
+
+        while True:
+            if since_id:
+                filters = {'sinceId': since_id}
+            else:
+                filters = {'startDate': options['start_date'].isoformat()}
+            result = self.request(self.client.orders_history, filters=filters, limit=100)
+            history = result.get('history') or []
+            if not history:
+                break
+
+            crm_ids = list({
+                change['order']['id'] for change in history if (change.get('order') or {}).get('id')
+            })
+            for offset in range(0, len(crm_ids), options['page_size']):
+                result = self.request(
+                    self.client.orders, filters={'ids': crm_ids[offset:offset + options['page_size']]},
+                    limit=options['page_size']
+                )
+                self.apply(result.get('orders') or [])
+
+            since_id = history[-1]['id']
+            service.set_retailcrm_cursor(IMPORT_HISTORY_CURSOR, since_id)
+            print(f'sinceId {since_id}: {self.progress()}')
+            if len(history) < 100:
+                break
+
+    @staticmethod
+    def request(method, **kwargs):
+        result = method(**kwargs).get_response()
+        if not result.get('success'):
+            raise CommandError(f'RetailCRM error: {result}')
+        return result
+
+    def apply(self, crm_orders):
+        self.updated += service.apply_retailcrm_orders(crm_orders, self.handbooks)
+        self.processed += len(crm_orders)
+
+    def progress(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.processed / elapsed if elapsed else 0
+        return f'{self.processed} orders, {self.updated} updated, {rate:.1f} orders/s'
@@ -1,26 +1,48 @@
-from time import sleep
-
-import retailcrm
-from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.utils import timezone
 
 from snippets.utils.email import send_trigger_email
 
+from ... import crm
 from ...api import service
-from ...models import Order
+from ...enums import RetailCRMSyncStatusEnum
+from ...models import RetailCRMOrderSync
 
 
 class Command(BaseCommand):
-    """Обновляем статусы платежей за 24 часа"""
+    """Выгружаем новые заказы в RetailCRM"""
 
-    def handle(self, *args, **options):
-        orders = Order.objects.filter(
-            retailcrm_id__isnull=True
-        ).exclude(
-            Q(order_number__startswith='m') |
-            Q(order_number__startswith='t')
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=1, help='Число заказов, выгружаемых одновременно'
+        )
+        parser.add_argument(
+            '--rate', type=float, default=None,
+            help='Запросов в секунду ко всему API RetailCRM (по умолчанию RETAIL_CRM_RATE_LIMIT)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=0,
+            help=f'Выгружать пачками через orders/upload (до {service.RETAIL_CRM_UPLOAD_LIMIT} заказов), '
+                 f'0 - по одному через orders/create'
+        )
+        parser.add_argument(
+            '--async', action='store_true',
+            help='Запросы всех потоков через один асинхронный клиент с пулом соединений'
         )
+        parser.add_argument(
+            '--retry-dead', action='store_true',
+            help='Вернуть в очередь заказы, которые не удалось выгрузить за все попытки'
+        )
+
+    def handle(self, *args, **options):
+        if options['retry_dead']:
+            requeued = RetailCRMOrderSync.objects.filter(status=RetailCRMSyncStatusEnum.DEAD).update(
+                status=RetailCRMSyncStatusEnum.PENDING, attempts=0, next_attempt=timezone.now(),
+                updated=timezone.now()
+            )
+            print(f'Requeued orders: {requeued}')
+
+        orders = service.get_orders_for_retailcrm_upload()
         # .filter(
         #     Q(
         #         Q(payment_status=PaymentStatusEnum.PAID)
@@ -29,20 +51,54 @@ class Command(BaseCommand):
         #     | ~Q(payment_type__payment_method__in=PaymentTypeEnum.online_types)
         # )
 
-        retailcrm_client = retailcrm.v5(settings.RETAIL_CRM_URL, settings.RETAIL_CRM_API_KEY)
-
         print('Uploading orders to retailcrm: %s' % orders.count())
-        for order in orders.iterator():
-            first_send = not bool(order.retail_crm_log)
-            result = service.upload_order_to_retailcrm(
-                order, retailcrm_client=retailcrm_client
+        batch_size = min(options['batch_size'], service.RETAIL_CRM_UPLOAD_LIMIT)
+        orders = service.select_retailcrm_related(orders).iterator(chunk_size=100)
+        if batch_size > 0:
+            objects, handle = crm.chunked(orders, batch_size), upload_orders
+        else:
+            objects, handle = orders, upload_order
+
+        client = None
+        if options['async']:
+            crm_async = crm.import_crm_async()
+            client = crm_async.BlockingClient(concurrency=options['workers'], rate=options['rate'])
+
+        try:
+            stats = crm.run_pool(
+                objects, handle, workers=options['workers'], rate=options['rate'], client=client
             )
+        finally:
+            if client is not None:
+                client.close()
+        print(stats)
+
+
+def upload_order(order, retailcrm_client):
+    return upload_orders([order], retailcrm_client, batch=False)[0]
+
+
+def upload_orders(orders, retailcrm_client, batch=True):
+    results = {order: False for order in orders}
+    try:
+        if batch:
+            results = service.upload_orders_to_retailcrm(orders, retailcrm_client=retailcrm_client)
+        else:
+            results[orders[0]] = service.upload_order_to_retailcrm(orders[0], retailcrm_client=retailcrm_client)
+    finally:
+        service.record_retailcrm_upload(results)
+
+    for order, result in results.items():
+        if not result and order.retailcrm_sync.attempts == 1:
+            notify_upload_failed(order)
+
+    return list(results.values())
+
 
-            if not result and first_send:
-                send_trigger_email(
-                    f'Не удалось отправить заказ №{order.order_number} '
-                    f'в RetailCRM',
-                    obj=order,
-                    fields=order.fast_order_email_fields,
-                )
-            sleep(.05)
+def notify_upload_failed(order):
+    send_trigger_email(
+        f'Не удалось отправить заказ №{order.order_number} '
+        f'в RetailCRM',
+        obj=order,
+        fields=order.fast_order_email_fields,
+    )
@@ -0,0 +1,38 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models import OrderIdempotencyKey
+
+IDEMPOTENCY_KEY_TTL_DAYS = 7
+
+
+class Command(BaseCommand):
+    """Удаляем ключи идемпотентности старше срока хранения (повтор запроса через столько
+    дней уже не ретрай, а новый заказ)"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int,
+            default=getattr(settings, 'IDEMPOTENCY_KEY_TTL_DAYS', IDEMPOTENCY_KEY_TTL_DAYS)
+        )
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(days=options['days'])
+        deleted = 0
+        while True:
+            ids = list(
+                OrderIdempotencyKey.objects.filter(created__lt=before).order_by('pk')
+                .values_list('pk', flat=True)[:options['chunk_size']]
+            )
+            if not ids:
+                break
+
+            OrderIdempotencyKey.objects.filter(pk__in=ids).delete()
+            deleted += len(ids)
+            print(f'Deleted: {deleted}')
+
+        print(f'Idempotency keys older than {options["days"]} days deleted: {deleted}')
@@ -0,0 +1,37 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models import RetailCRMLog
+
+RETAIL_CRM_LOG_RETENTION_DAYS = 90
+
+
+class Command(BaseCommand):
+    """Удаляем записи журнала RetailCRM старше срока хранения"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int,
+            default=getattr(settings, 'RETAIL_CRM_LOG_RETENTION_DAYS', RETAIL_CRM_LOG_RETENTION_DAYS)
+        )
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(days=options['days'])
+        deleted = 0
+        while True:
+            ids = list(
+                RetailCRMLog.objects.filter(created__lt=before).order_by('pk')
+                .values_list('pk', flat=True)[:options['chunk_size']]
+            )
+            if not ids:
+                break
+
+            RetailCRMLog.objects.filter(pk__in=ids).delete()
+            deleted += len(ids)
+            print(f'Deleted: {deleted}')
+
+        print(f'RetailCRM log entries older than {options["days"]} days deleted: {deleted}')
@@ -0,0 +1,29 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from ...api.service import send_order_notifications
+
+
+class Command(BaseCommand):
+    """Отправляем накопившиеся уведомления по заказам"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument(
+            '--forever', action='store_true',
+            help='Не завершаться, проверять очередь каждые --interval секунд'
+        )
+        parser.add_argument('--interval', type=float, default=5)
+
+    def handle(self, *args, **options):
+        while True:
+            sent_count, failed_count = send_order_notifications(batch_size=options['batch_size'])
+            if sent_count or failed_count:
+                print(f'Notifications sent: {sent_count}, failed: {failed_count}')
+                continue
+
+            if not options['forever']:
+                break
+
+            sleep(options['interval'])
@@ -0,0 +1,165 @@
+"""Замеры фаз оформления заказа.
+
+Для каждой фазы (валидация, проверка остатков, номер заказа, ...) запоминается время и число
+запросов к БД. Данные копятся в гистограммах процесса и отдаются в текстовом формате
+Prometheus, а также (по настройке) в заголовке Server-Timing ответа.
+
+Настройки:
+    ORDERS_CHECKOUT_METRICS - включить замеры (по умолчанию выключены, накладные расходы -
+        один вызов nullcontext на фазу)
+    ORDERS_CHECKOUT_SERVER_TIMING - добавлять заголовок Server-Timing
+
+Ограничение: гистограммы у каждого процесса свои и не объединяются. При нескольких воркерах
+(gunicorn, uwsgi) запрос метрик попадает в случайный воркер и показывает только его замеры,
+поэтому метрики нужно собирать с одного воркера или с каждого воркера отдельно
+(отдельный порт на воркер и метка instance)
+"""
+import threading
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connection
+
+DURATION_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def render(self, name, labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class CheckoutMetrics:
+    """Гистограммы длительности и числа запросов по фазам (в пределах процесса)"""
+
+    def __init__(self):
+        self.durations = {}
+        self.queries = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, phase, duration, queries):
+        key = (endpoint, phase)
+        with self._lock:
+            if key not in self.durations:
+                self.durations[key] = Histogram(DURATION_BUCKETS)
+                self.queries[key] = Histogram(QUERIES_BUCKETS)
+            self.durations[key].observe(duration)
+            self.queries[key].observe(queries)
+
+    def render(self) -> str:
+        lines = [
+            '# HELP orders_checkout_phase_seconds Checkout phase wall time',
+            '# TYPE orders_checkout_phase_seconds histogram',
+        ]
+        with self._lock:
+            for (endpoint, phase), histogram in sorted(self.durations.items()):
+                lines += histogram.render(
+                    'orders_checkout_phase_seconds', f'endpoint="{endpoint}",phase="{phase}"'
+                )
+
+            lines += [
+                '# HELP orders_checkout_phase_queries Checkout phase DB queries',
+                '# TYPE orders_checkout_phase_queries histogram',
+            ]
+            for (endpoint, phase), histogram in sorted(self.queries.items()):
+                lines += histogram.render(
+                    'orders_checkout_phase_queries', f'endpoint="{endpoint}",phase="{phase}"'
+                )
+
+        return '\n'.join(lines) + '\n'
+
+
+checkout_metrics = CheckoutMetrics()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class CheckoutTimer:
+    """Замер фаз одного запроса оформления заказа"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        counter = QueryCounter()
+        started = perf_counter()
+        try:
+            with connection.execute_wrapper(counter):
+                yield
+        finally:
+            self.phases.append((name, perf_counter() - started, counter.count))
+
+    def finish(self, response):
+        for name, duration, queries in self.phases:
+            checkout_metrics.observe(self.endpoint, name, duration, queries)
+
+        if getattr(settings, 'ORDERS_CHECKOUT_SERVER_TIMING', False):
+            response['Server-Timing'] = ', '.join(
+                f'{name};dur={duration * 1000:.1f}' for name, duration, _ in self.phases
+            )
+
+        return response
+
+
+class NullCheckoutTimer:
+    """Замеры выключены"""
+
+    @staticmethod
+    def phase(name):
+        return nullcontext()
+
+    @staticmethod
+    def finish(response):
+        return response
+
+
+null_checkout_timer = NullCheckoutTimer()
+
+
+def get_checkout_timer(endpoint):
+    if not getattr(settings, 'ORDERS_CHECKOUT_METRICS', False):
+        return null_checkout_timer
+
+    return CheckoutTimer(endpoint)
+
+
+def render_metrics() -> str:
+    from orders.cache import handbooks_cache
+
+    lines = [
+        '# HELP orders_cache_events_total Orders caches hits and misses',
+        '# TYPE orders_cache_events_total counter',
+    ]
+    for event, count in sorted(handbooks_cache.get_stats().items()):
+        lines.append(f'orders_cache_events_total{{event="{event}"}} {count}')
+
+    return checkout_metrics.render() + '\n'.join(lines) + '\n'
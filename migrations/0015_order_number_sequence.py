@@ -0,0 +1,41 @@
+from django.db import migrations
+from django.db.models.functions import Length
+
+# значения orders.utils на момент миграции
+FIRST_ORDER = 110
+ORDER_NUMBER_SEQUENCE = 'orders_order_number_seq'
+
+
+def create_order_number_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    Order = apps.get_model('orders', 'Order')
+    last_order_number = Order.objects.filter(
+        order_number__regex=r'^\d+$'
+    ).order_by(
+        Length('order_number').desc(), '-order_number'
+    ).values_list('order_number', flat=True).first()
+    start = int(last_order_number) + 1 if last_order_number else FIRST_ORDER + 1
+
+    schema_editor.execute(
+        f'CREATE SEQUENCE IF NOT EXISTS {ORDER_NUMBER_SEQUENCE} START WITH {start}'
+    )
+
+
+def drop_order_number_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute(f'DROP SEQUENCE IF EXISTS {ORDER_NUMBER_SEQUENCE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0014_order_bonus_amount'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_order_number_sequence, drop_order_number_sequence),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.6 on 2026-10-18 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0015_order_number_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Создано')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('kind', models.CharField(choices=[('order_customer', 'Покупателю о заказе'), ('fast_order_customer', 'Покупателю о быстром заказе'), ('fast_order_trigger', 'Менеджерам о быстром заказе')], max_length=30, verbose_name='Тип')),
+                ('status', models.CharField(choices=[('new', 'Ожидает отправки'), ('sent', 'Отправлено'), ('failed', 'Не удалось отправить')], default='new', max_length=10, verbose_name='Статус')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток отправки')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Следующая попытка')),
+                ('error', models.TextField(blank=True, null=True, verbose_name='Ошибка')),
+                ('request_meta', models.JSONField(blank=True, null=True, verbose_name='Данные запроса')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='orders.order', verbose_name='Заказ')),
+            ],
+            options={
+                'verbose_name': 'Уведомление по заказу',
+                'verbose_name_plural': 'Уведомления по заказам',
+                'ordering': ('created',),
+                'indexes': [models.Index(fields=['status', 'next_attempt'], name='orders_notif_status_next_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0019_order_orders_order_user_created_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetailCRMCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Создано')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='Название')),
+                ('value', models.CharField(blank=True, max_length=100, verbose_name='Значение')),
+            ],
+            options={
+                'verbose_name': 'Позиция синхронизации RetailCRM',
+                'verbose_name_plural': 'Позиции синхронизации RetailCRM',
+            },
+        ),
+    ]
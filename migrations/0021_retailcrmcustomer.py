@@ -0,0 +1,30 @@
+# Generated by Django 4.2.6 on 2026-10-18 13:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('orders', '0020_retailcrmcursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetailCRMCustomer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Создано')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('profile_hash', models.CharField(max_length=64, verbose_name='Хеш данных')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='retailcrm_customer', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Покупатель RetailCRM',
+                'verbose_name_plural': 'Покупатели RetailCRM',
+            },
+        ),
+    ]
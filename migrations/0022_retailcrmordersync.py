@@ -0,0 +1,50 @@
+# Generated by Django 4.2.6 on 2026-10-18 14:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def enqueue_pending_orders(apps, schema_editor):
+    Order = apps.get_model('orders', 'Order')
+    RetailCRMOrderSync = apps.get_model('orders', 'RetailCRMOrderSync')
+
+    # как Order.retailcrm_excluded_prefixes: такие заказы в RetailCRM не выгружаются
+    order_ids = Order.objects.filter(
+        retailcrm_id__isnull=True
+    ).exclude(
+        order_number__startswith='m'
+    ).exclude(
+        order_number__startswith='t'
+    ).values_list('id', flat=True)
+    RetailCRMOrderSync.objects.bulk_create(
+        (RetailCRMOrderSync(order_id=order_id) for order_id in order_ids.iterator()), batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0021_retailcrmcustomer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetailCRMOrderSync',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Создано')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает выгрузки'), ('uploaded', 'Выгружен'), ('dead', 'Не удалось выгрузить')], default='pending', max_length=10, verbose_name='Статус')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток выгрузки')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Следующая попытка')),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='retailcrm_sync', to='orders.order', verbose_name='Заказ')),
+            ],
+            options={
+                'verbose_name': 'Выгрузка заказа в RetailCRM',
+                'verbose_name_plural': 'Выгрузка заказов в RetailCRM',
+                'indexes': [models.Index(fields=['status', 'next_attempt'], name='orders_crmsync_status_next_idx')],
+            },
+        ),
+        migrations.RunPython(enqueue_pending_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.6 on 2026-10-18 15:30
+
+import zlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+
+
+def move_retail_crm_logs(apps, schema_editor):
+    Order = apps.get_model('orders', 'Order')
+    RetailCRMLog = apps.get_model('orders', 'RetailCRMLog')
+
+    logs = (
+        Order.objects.exclude(retail_crm_log__isnull=True).exclude(retail_crm_log='')
+        .values_list('id', 'retail_crm_log').iterator()
+    )
+    RetailCRMLog.objects.bulk_create(
+        (RetailCRMLog(order_id=order_id, message=zlib.compress(text.encode())) for order_id, text in logs),
+        batch_size=1000
+    )
+    # auto_now_add ставит дату переноса, запись получает дату последнего изменения заказа
+    RetailCRMLog.objects.update(
+        created=Subquery(Order.objects.filter(pk=OuterRef('order_id')).values('updated')[:1])
+    )
+
+
+def restore_retail_crm_logs(apps, schema_editor):
+    Order = apps.get_model('orders', 'Order')
+    RetailCRMLog = apps.get_model('orders', 'RetailCRMLog')
+
+    # в поле заказа остается последняя запись журнала
+    for log in RetailCRMLog.objects.order_by('created').iterator():
+        Order.objects.filter(pk=log.order_id).update(
+            retail_crm_log=zlib.decompress(bytes(log.message)).decode()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0022_retailcrmordersync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetailCRMLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.BinaryField(verbose_name='Сообщение (zlib)')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Создано')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='retailcrm_logs', to='orders.order', verbose_name='Заказ')),
+            ],
+            options={
+                'verbose_name': 'Лог RetailCRM',
+                'verbose_name_plural': 'Лог RetailCRM',
+                'ordering': ('-created',),
+            },
+        ),
+        migrations.RunPython(move_retail_crm_logs, restore_retail_crm_logs),
+        migrations.RemoveField(
+            model_name='order',
+            name='retail_crm_log',
+        ),
+    ]
@@ -1,40 +1,116 @@
 import decimal
+import zlib
 
 from django.conf import settings
 from django.db import models
-from django.db.models import OuterRef, Count, Subquery, Prefetch
-from django.db.models import Sum
+from django.db.models import Prefetch
+from django.utils import timezone
 
 from coupons.api.service import calculate_coupon_items_discount
 from handbooks.enums import PaymentTypeEnum
 from orders import ADDRESS_MAPPING
+from orders.enums import OrderNotificationKindEnum, OrderNotificationStatusEnum, RetailCRMSyncStatusEnum
+from orders.pricing import PricingRules, calc_totals, get_items_amount
 from snippets.enums import PaymentStatusEnum
 from snippets.models import LastModMixin, BasicModel, BaseManager
 from snippets.models.abstract import BaseQuerySet
 from snippets.utils.passwords import generate_alt_id
 
 
+class TrackFieldsMixin:
+    """Запоминает значения полей, загруженные из БД.
+
+    save() сохраненного объекта записывает только измененные поля (update_fields)
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_field_values()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.remember_field_values()
+
+    def remember_field_values(self):
+        self._loaded_values = {
+            f.attname: self.__dict__[f.attname]
+            for f in self._meta.concrete_fields if f.attname in self.__dict__
+        }
+
+    def get_loaded_value(self, attname, default=None):
+        return getattr(self, '_loaded_values', {}).get(attname, default)
+
+    def get_changed_fields(self):
+        """Имена измененных полей или None, если объект не загружался из БД"""
+        loaded_values = getattr(self, '_loaded_values', None)
+        if loaded_values is None:
+            return None
+
+        return {
+            f.attname for f in self._meta.concrete_fields
+            if not f.primary_key and f.attname in self.__dict__ and (
+                f.attname not in loaded_values
+                or loaded_values[f.attname] != self.__dict__[f.attname]
+            )
+        }
+
+    def save(self, *args, **kwargs):
+        changed_fields = self.get_changed_fields()
+        if changed_fields is not None and self.pk and not kwargs.get('update_fields') \
+                and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = changed_fields | {'updated'}
+
+        result = super().save(*args, **kwargs)
+        self.remember_field_values()
+        return result
+
+
 class OrderQuerySet(BaseQuerySet):
-    def get_list(self, user):
-        order_item = OrderItem.objects.filter(
-            order=OuterRef('pk')
-        ).values_list('quantity', flat=True)[:1]
+    def get_list(self, user, only=None, items_only=None, with_items=True):
+        return self.get_history(user, ('status',), only, items_only, with_items)
+
+    def get_retrieve(self, user, only=None, items_only=None, with_items=True):
+        return self.get_history(user, ('status', 'delivery_type'), only, items_only, with_items)
+
+    def get_history(self, user, related, only=None, items_only=None, with_items=True):
+        """История заказов пользователя.
+
+        only/items_only - колонки заказов и позиций для .only(), None - все колонки.
+        Связи из related присоединяются, только если их колонки есть в only
+        """
+        queryset = self.filter(user=user).order_by('-created', '-id')
+
+        if items_only is None:
+            items = OrderItem.objects.select_related('card')
+        else:
+            items = OrderItem.objects.only('order', *items_only)
+            if 'card' in items_only:
+                items = items.select_related('card')
+        if with_items:
+            queryset = queryset.prefetch_related(Prefetch('items', queryset=items))
+
+        if only is None:
+            return queryset.select_related(*related)
+
+        related = [name for name in related if name in only]
+        if related:
+            queryset = queryset.select_related(*related)
+        return queryset.only('created', *only)
+
+    def get_list_values(self, user, columns=None):
+        """Узкая выборка истории заказов для сборки ответа без сериализаторов"""
         return self.filter(
             user=user
-        ).select_related(
-            'status'
-        ).prefetch_related(
-            Prefetch(
-                'items',
-                queryset=OrderItem.objects.select_related('card')
-            ),
-        ).annotate(total_count=Count(Subquery(order_item))).order_by('-created')
-
-    def get_retrieve(self, user):
-        return self.get_list(user=user).select_related('delivery_type')
+        ).order_by(
+            '-created', '-id'
+        ).values(
+            'id', 'created', *(columns or ())
+        )
 
 
-class Order(LastModMixin, BasicModel):
+class Order(TrackFieldsMixin, LastModMixin, BasicModel):
     """Заказ """
 
     user = models.ForeignKey(
@@ -95,10 +171,11 @@ class Order(LastModMixin, BasicModel):
         'Скидка по промокоду', max_digits=11, decimal_places=2, blank=True, null=True
     )
     retailcrm_id = models.IntegerField('ID в RetailCRM', blank=True, null=True)
-    retail_crm_log = models.TextField('Лог RetailCRM', blank=True, null=True)
 
     congratulation = models.TextField('Поздравление', blank=True, null=True)
 
+    items_count = models.PositiveIntegerField('Позиций', default=0)
+    total_quantity = models.PositiveIntegerField('Количество товаров', default=0)
     items_amount = models.DecimalField(
         'Стоимость товара', max_digits=11, decimal_places=2, blank=True, default=0
     )
@@ -165,45 +242,101 @@ class Order(LastModMixin, BasicModel):
         'items_amount', 'delivery_amount', 'discount_amount', 'total_amount'
     )
 
+    # суммы, которые пересчитываются при изменении позиций и полей ниже
+    totals_fields = (
+        'items_count', 'total_quantity', 'items_amount', 'coupon_amount', 'discount_amount',
+        'comission', 'total_amount'
+    )
+    # изменения этих полей требуют перечитать позиции заказа (изменения самих позиций
+    # учитывает OrderItem.save/delete)
+    items_totals_source_fields = {'coupon_id'}
+    # изменения этих полей и самих сумм пересчитываются по уже известным суммам
+    totals_source_fields = {'payment_type_id', 'delivery_amount', 'bonus_amount', *totals_fields}
+    # заказы с такими номерами в RetailCRM не выгружаются
+    retailcrm_excluded_prefixes = ('m', 't')
+
     objects = BaseManager.from_queryset(OrderQuerySet)()
     
     class Meta:
         ordering = ('-created',)
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
+        indexes = (
+            models.Index(fields=('user', '-created', '-id'), name='orders_order_user_created_idx'),
+        )
 
     def __str__(self):
         return self.order_number
 
+    def is_retailcrm_upload_needed(self):
+        return not self.retailcrm_id and not self.order_number.startswith(self.retailcrm_excluded_prefixes)
+
     def get_payment_id(self):
         return '%s%s' % ('test-' if settings.DEBUG else '', self.order_number)
 
-    def save(self, *args, **kwargs):
-        self.update_totals()
+    def save(self, *args, update_totals=True, **kwargs):
+        if update_totals:
+            changed_fields = self.get_changed_fields()
+            if changed_fields is None or changed_fields & self.items_totals_source_fields:
+                self.update_totals()
+            elif changed_fields & self.totals_source_fields:
+                self.update_total_amount()
+
         return super(Order, self).save(*args, **kwargs)
 
-    def update_totals(self):
-        if self.pk:
+    def update_totals(self, items=None):
+        """Пересчитывает суммы заказа.
+
+        Если позиции не переданы, они загружаются из БД (только для сохраненного заказа)
+        """
+        if items is None:
+            if not self.pk:
+                return
             items = self.items.all()
-            self.items_amount = sum([
-                x.price * x.quantity for x in items if x.price and x.quantity
-            ])
-
-            if self.coupon_id:
-                self.coupon_amount = min(
-                    calculate_coupon_items_discount(self.coupon, items),
-                    self.items_amount
-                )
-            else:
-                self.coupon_amount = decimal.Decimal('0')
 
-            self.discount_amount = self.coupon_amount
-            self.comission = self.items_amount * decimal.Decimal(self.payment_type.comission_percent) / 100
-            self.total_amount = self.items_amount + self.comission \
-                                + decimal.Decimal(
-                self.delivery_amount if self.delivery_amount else 0) \
-                                - decimal.Decimal(self.discount_amount or 0) \
-            - decimal.Decimal(self.bonus_amount or 0)
+        self.items_count = len(items)
+        self.total_quantity = sum(x.quantity or 0 for x in items)
+        self.items_amount = get_items_amount((x.price, x.quantity) for x in items)
+
+        if self.coupon_id:
+            # не больше стоимости товаров, ограничивается в update_total_amount
+            self.coupon_amount = calculate_coupon_items_discount(self.coupon, items)
+        else:
+            self.coupon_amount = decimal.Decimal('0')
+
+        self.update_total_amount()
+
+    def get_pricing_rules(self) -> PricingRules:
+        return PricingRules(
+            comission_percent=self.payment_type.comission_percent if self.payment_type_id else 0,
+            delivery_amount=self.delivery_amount,
+            coupon_items_discount=self.coupon_amount,
+            bonus_amount=self.bonus_amount
+        )
+
+    def update_total_amount(self):
+        """Пересчитывает скидку, комиссию и итог по уже посчитанным суммам товаров и промокода"""
+        totals = calc_totals(self.items_amount, self.get_pricing_rules())
+        self.coupon_amount = totals.coupon_amount
+        self.discount_amount = totals.discount_amount
+        self.comission = totals.comission
+        self.total_amount = totals.total_amount
+
+    def apply_items_change(self, amount_delta, quantity_delta=0, count_delta=0):
+        """Учитывает изменение позиций заказа без перечитывания всех позиций.
+
+        Скидка по промокоду зависит от состава заказа, поэтому при промокоде (и при неизвестном
+        изменении amount_delta=None) суммы пересчитываются полностью
+        """
+        if self.coupon_id or amount_delta is None:
+            self.update_totals()
+        else:
+            self.items_count = (self.items_count or 0) + count_delta
+            self.total_quantity = (self.total_quantity or 0) + quantity_delta
+            self.items_amount = (self.items_amount or 0) + amount_delta
+            self.update_total_amount()
+
+        self.save(update_totals=False, update_fields=(*self.totals_fields, 'updated'))
 
     @property
     def address_full(self):
@@ -224,17 +357,12 @@ class Order(LastModMixin, BasicModel):
 
         return res
 
-    @property
-    def total_quantity(self):
-        total = self.items.aggregate(Sum('quantity'))
-        return total['quantity__sum'] if total.get('quantity__sum') else 0
-
     @property
     def admin_url(self):
         return "/%s/%s/%s/change/" % (self._meta.app_label, self._meta.model_name, self.id)
 
 
-class OrderItem(LastModMixin, BasicModel):
+class OrderItem(TrackFieldsMixin, LastModMixin, BasicModel):
     """Элементы заказа"""
 
     order = models.ForeignKey(
@@ -271,6 +399,44 @@ class OrderItem(LastModMixin, BasicModel):
     def total_amount(self):
         return self.quantity * self.price
 
+    def get_loaded_amount(self):
+        price = self.get_loaded_value('price', self.price)
+        quantity = self.get_loaded_value('quantity', self.quantity)
+        return (price or 0) * (quantity or 0)
+
+    def save(self, *args, update_order_totals=True, **kwargs):
+        if not update_order_totals:
+            return super(OrderItem, self).save(*args, **kwargs)
+
+        amount_delta = (self.price or 0) * (self.quantity or 0)
+        quantity_delta = self.quantity or 0
+        count_delta = 1
+        if not self._state.adding:
+            count_delta = 0
+            if self.get_changed_fields() is None:
+                # прежняя стоимость позиции неизвестна, суммы заказа пересчитываются полностью
+                amount_delta = None
+            else:
+                amount_delta -= self.get_loaded_amount()
+                quantity_delta -= self.get_loaded_value('quantity') or 0
+
+        result = super(OrderItem, self).save(*args, **kwargs)
+        if amount_delta is None or amount_delta or quantity_delta or count_delta:
+            self.order.apply_items_change(amount_delta, quantity_delta, count_delta)
+
+        return result
+
+    def delete(self, *args, update_order_totals=True, **kwargs):
+        if not update_order_totals:
+            return super(OrderItem, self).delete(*args, **kwargs)
+
+        amount_delta = -self.get_loaded_amount()
+        quantity_delta = -(self.get_loaded_value('quantity', self.quantity) or 0)
+        result = super(OrderItem, self).delete(*args, **kwargs)
+        self.order.apply_items_change(amount_delta, quantity_delta, -1)
+
+        return result
+
 
 class OrderStatusLog(LastModMixin, BasicModel):
     """Статусы заказа"""
@@ -316,3 +482,154 @@ class OrderStatusLog(LastModMixin, BasicModel):
             #     self.is_email_sent = True
 
         return super(OrderStatusLog, self).save(*args, **kwargs)
+
+
+class OrderNotification(LastModMixin, BasicModel):
+    """Исходящее уведомление по заказу.
+
+    Записывается в транзакции оформления заказа и отправляется командой
+    send_order_notifications
+    """
+
+    order = models.ForeignKey(
+        'orders.Order', related_name='notifications', on_delete=models.CASCADE,
+        verbose_name='Заказ'
+    )
+    kind = models.CharField(
+        'Тип', max_length=30, choices=OrderNotificationKindEnum.get_choices()
+    )
+    status = models.CharField(
+        'Статус', max_length=10, choices=OrderNotificationStatusEnum.get_choices(),
+        default=OrderNotificationStatusEnum.default
+    )
+    attempts = models.PositiveSmallIntegerField('Попыток отправки', default=0)
+    next_attempt = models.DateTimeField('Следующая попытка', default=timezone.now)
+    error = models.TextField('Ошибка', blank=True, null=True)
+    request_meta = models.JSONField('Данные запроса', blank=True, null=True)
+
+    class Meta:
+        ordering = ('created',)
+        verbose_name = 'Уведомление по заказу'
+        verbose_name_plural = 'Уведомления по заказам'
+        indexes = (
+            models.Index(fields=('status', 'next_attempt'), name='orders_notif_status_next_idx'),
+        )
+
+    def __str__(self):
+        return f'{self.order} - {self.get_kind_display()}'
+
+
+class OrderIdempotencyKey(LastModMixin, BasicModel):
+    """Ключ идемпотентности оформления заказа (заголовок Idempotency-Key)"""
+
+    key = models.CharField('Ключ', max_length=64, unique=True)
+    user = models.ForeignKey(
+        'users.User', related_name='+', verbose_name='Пользователь',
+        on_delete=models.CASCADE, blank=True, null=True
+    )
+    order = models.ForeignKey(
+        'orders.Order', related_name='idempotency_keys', verbose_name='Заказ',
+        on_delete=models.CASCADE, blank=True, null=True
+    )
+    response = models.JSONField('Ответ', blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Ключ идемпотентности'
+        verbose_name_plural = 'Ключи идемпотентности'
+
+    def __str__(self):
+        return self.key
+
+
+class RetailCRMCursor(LastModMixin, BasicModel):
+    """Сохраненная позиция синхронизации с RetailCRM (например, sinceId истории заказов)"""
+
+    name = models.CharField('Название', max_length=50, unique=True)
+    value = models.CharField('Значение', max_length=100, blank=True)
+
+    class Meta:
+        verbose_name = 'Позиция синхронизации RetailCRM'
+        verbose_name_plural = 'Позиции синхронизации RetailCRM'
+
+    def __str__(self):
+        return f'{self.name}: {self.value}'
+
+
+class RetailCRMCustomer(LastModMixin, BasicModel):
+    """Покупатель, уже синхронизированный с RetailCRM.
+
+    profile_hash - хеш последних отправленных данных, пока он не меняется,
+    запросы о покупателе в RetailCRM не выполняются
+    """
+
+    user = models.OneToOneField(
+        'users.User', related_name='retailcrm_customer', verbose_name='Пользователь',
+        on_delete=models.CASCADE
+    )
+    profile_hash = models.CharField('Хеш данных', max_length=64)
+
+    class Meta:
+        verbose_name = 'Покупатель RetailCRM'
+        verbose_name_plural = 'Покупатели RetailCRM'
+
+    def __str__(self):
+        return str(self.user_id)
+
+
+class RetailCRMOrderSync(LastModMixin, BasicModel):
+    """Очередь выгрузки заказа в RetailCRM.
+
+    Неудачная выгрузка повторяется с растущей задержкой, после нескольких попыток
+    заказ остается в статусе DEAD и больше не выбирается
+    """
+
+    order = models.OneToOneField(
+        'orders.Order', related_name='retailcrm_sync', verbose_name='Заказ',
+        on_delete=models.CASCADE
+    )
+    status = models.CharField(
+        'Статус', max_length=10, choices=RetailCRMSyncStatusEnum.get_choices(),
+        default=RetailCRMSyncStatusEnum.default
+    )
+    attempts = models.PositiveSmallIntegerField('Попыток выгрузки', default=0)
+    next_attempt = models.DateTimeField('Следующая попытка', default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Выгрузка заказа в RetailCRM'
+        verbose_name_plural = 'Выгрузка заказов в RetailCRM'
+        indexes = (
+            models.Index(fields=('status', 'next_attempt'), name='orders_crmsync_status_next_idx'),
+        )
+
+    def __str__(self):
+        return f'{self.order_id}: {self.get_status_display()}'
+
+
+class RetailCRMLog(BasicModel):
+    """Запрос и ответ RetailCRM по заказу (журнал только пополняется, поэтому без updated).
+
+    Текст хранится сжатым zlib, чтобы журнал не раздувал таблицу заказов
+    """
+
+    order = models.ForeignKey(
+        'orders.Order', related_name='retailcrm_logs', verbose_name='Заказ',
+        on_delete=models.CASCADE
+    )
+    message = models.BinaryField('Сообщение (zlib)')
+    created = models.DateTimeField('Создано', auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name = 'Лог RetailCRM'
+        verbose_name_plural = 'Лог RetailCRM'
+
+    def __str__(self):
+        return f'{self.order_id}: {self.created}'
+
+    @classmethod
+    def from_text(cls, order, text):
+        return cls(order=order, message=zlib.compress(text.encode()))
+
+    @property
+    def text(self):
+        return zlib.decompress(bytes(self.message)).decode()
@@ -0,0 +1,77 @@
+"""Расчет сумм заказа.
+
+Функции модуля не обращаются к БД и моделям: на вход подаются позиции (цена, количество)
+и правила расчета, поэтому один и тот же код считает корзину при оформлении, суммы заказа
+при сохранении и пересчет тысяч заказов пачкой
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+ZERO = Decimal(0)
+HUNDRED = Decimal(100)
+
+PricingItem = namedtuple('PricingItem', ('price', 'quantity'))
+
+PricingRules = namedtuple(
+    'PricingRules',
+    (
+        'comission_percent',  # комиссия способа оплаты, % от стоимости товаров
+        'delivery_amount',  # стоимость доставки до скидки по промокоду
+        'coupon_items_discount',  # скидка промокода на товары
+        'coupon_delivery_discount',  # скидка промокода на доставку
+        'bonus_amount',  # оплата бонусами
+    ),
+    defaults=(0, 0, 0, 0, 0)
+)
+
+OrderTotals = namedtuple(
+    'OrderTotals',
+    (
+        'items_amount', 'coupon_amount', 'delivery_amount', 'discount_amount', 'comission',
+        'total_amount'
+    )
+)
+
+
+def get_items_amount(items) -> Decimal:
+    """Стоимость позиций"""
+    return sum((price * quantity for price, quantity in items if price and quantity), ZERO)
+
+
+def calc_totals(items_amount, rules: PricingRules) -> OrderTotals:
+    """Суммы заказа по стоимости товаров"""
+    items_amount = Decimal(items_amount or 0)
+    coupon_amount = min(Decimal(rules.coupon_items_discount or 0), items_amount)
+    delivery_discount = Decimal(rules.coupon_delivery_discount or 0)
+    delivery_amount = Decimal(rules.delivery_amount or 0) - delivery_discount
+    comission = items_amount * Decimal(rules.comission_percent or 0) / HUNDRED
+
+    return OrderTotals(
+        items_amount=items_amount,
+        coupon_amount=coupon_amount,
+        delivery_amount=delivery_amount,
+        discount_amount=coupon_amount + delivery_discount,
+        comission=comission,
+        total_amount=(
+            items_amount + comission + delivery_amount - coupon_amount
+            - Decimal(rules.bonus_amount or 0)
+        )
+    )
+
+
+def price_order(items, rules: PricingRules) -> OrderTotals:
+    """Суммы заказа по позициям"""
+    return calc_totals(get_items_amount(items), rules)
+
+
+def price_orders(orders) -> list:
+    """Суммы для пачки заказов, orders - последовательность пар (позиции, правила)"""
+    return [calc_totals(get_items_amount(items), rules) for items, rules in orders]
+
+
+def is_free_delivery(items_amount, free_delivery_limit, is_price_from=False) -> bool:
+    """Является ли доставка бесплатной по объему покупки (если включен такой режим)"""
+    if is_price_from:
+        return False
+
+    return bool(free_delivery_limit) and items_amount >= free_delivery_limit
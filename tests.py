@@ -0,0 +1,631 @@
+import datetime
+import io
+import itertools
+import re
+import uuid
+from contextlib import redirect_stdout
+from decimal import Decimal
+from unittest import mock
+
+from carts import MIN_AVAILABILITY
+from carts.models import CartItem
+from catalog.models import ProductOffer, ProductOfferCard
+from coupons.models import Coupon, CouponEntry
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection, models as db_models
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+from django.utils import timezone
+from handbooks.models import DeliveryListPoint, OrderStatus, PaymentType, Region, SelfDeliveryPoint
+
+from orders import models
+from orders import cache
+from orders.api import serializers, service, views
+from orders.api.pagination import OrderHistoryCursorPagination
+from snippets.enums import PaymentStatusEnum
+
+from orders.enums import OrderNotificationKindEnum, OrderNotificationStatusEnum, RetailCRMSyncStatusEnum
+
+counter = itertools.count(1)
+
+
+def make(model, **values):
+    """Сохраненный объект model: обязательные поля без значения по умолчанию заполняются
+    тестовыми значениями, обязательные связи создаются так же"""
+    for field in model._meta.concrete_fields:
+        if field.name in values or field.attname in values or field.primary_key or field.null \
+                or field.has_default() or getattr(field, 'auto_now', False) \
+                or getattr(field, 'auto_now_add', False):
+            continue
+        values[field.name] = get_test_value(field)
+
+    return model.objects.create(**values)
+
+
+def get_test_value(field):
+    number = next(counter)
+    if field.is_relation:
+        return make(field.related_model)
+    if field.choices:
+        return field.choices[0][0]
+    if isinstance(field, db_models.BooleanField):
+        return False
+    if isinstance(field, db_models.DateTimeField):
+        return timezone.now()
+    if isinstance(field, db_models.DateField):
+        return timezone.localdate()
+    if isinstance(field, db_models.DecimalField):
+        return Decimal(1)
+    if isinstance(field, (db_models.IntegerField, db_models.FloatField)):
+        return number
+    if isinstance(field, db_models.UUIDField):
+        return uuid.uuid4()
+    if isinstance(field, db_models.JSONField):
+        return {}
+    if isinstance(field, db_models.EmailField):
+        return f'test{number}@example.com'
+    if isinstance(field, db_models.FileField):
+        return f'test/{number}.jpg'
+    return f'{field.name}-{number}'[:field.max_length]
+
+
+def make_order(**values):
+    values.setdefault('order_number', str(100000 + next(counter)))
+    values.setdefault('first_name', 'Иван')
+    values.setdefault('phone', '+79990000000')
+    values.setdefault('email', 'ivan@example.com')
+    if 'status' not in values:
+        values['status'] = make(OrderStatus, title='Новый')
+    return models.Order.objects.create(**values)
+
+
+class AcquireAmountsTestCase(TestCase):
+    def make_cart_item(self, amount, quantity):
+        offer = make(ProductOffer, amount=amount)
+        return make(CartItem, offer=offer, quantity=quantity)
+
+    def test_decreased(self):
+        cart_item = self.make_cart_item(MIN_AVAILABILITY, MIN_AVAILABILITY + 2)
+
+        error = service.acquire_amounts(None, [cart_item])
+
+        self.assertIn('уменьшено', error)
+        cart_item.refresh_from_db()
+        self.assertEqual(cart_item.quantity, MIN_AVAILABILITY)
+        self.assertEqual(ProductOffer.objects.get(pk=cart_item.offer_id).amount, MIN_AVAILABILITY)
+
+    def test_removed_and_decreased(self):
+        removed = self.make_cart_item(MIN_AVAILABILITY - 1, 1)
+        decreased = self.make_cart_item(MIN_AVAILABILITY, MIN_AVAILABILITY + 2)
+
+        with mock.patch.object(service, 'remove_cart_item') as remove_cart_item:
+            error = service.acquire_amounts('cart', [removed, decreased])
+
+        self.assertEqual(error, 'Некоторые товары из корзины закончились')
+        remove_cart_item.assert_called_once_with('cart', removed.id)
+        decreased.refresh_from_db()
+        self.assertEqual(decreased.quantity, MIN_AVAILABILITY)
+
+    def test_reserved(self):
+        cart_item = self.make_cart_item(MIN_AVAILABILITY + 2, 2)
+
+        self.assertIsNone(service.acquire_amounts(None, [cart_item]))
+
+        self.assertEqual(ProductOffer.objects.get(pk=cart_item.offer_id).amount, MIN_AVAILABILITY)
+
+
+class IdempotencyKeyTestCase(TestCase):
+    def test_release(self):
+        record = service.lock_idempotency_key('key')
+        service.release_idempotency_key(record)
+        service.release_idempotency_key(None)
+
+        self.assertFalse(models.OrderIdempotencyKey.objects.exists())
+        self.assertIsNone(service.get_idempotent_response('key'))
+        self.assertIsNone(service.lock_idempotency_key('key').response)
+
+    def test_prune(self):
+        old = models.OrderIdempotencyKey.objects.create(key='old', response={'id': 1})
+        fresh = models.OrderIdempotencyKey.objects.create(key='fresh', response={'id': 2})
+        models.OrderIdempotencyKey.objects.filter(id=old.id).update(
+            created=timezone.now() - datetime.timedelta(days=8)
+        )
+
+        with redirect_stdout(io.StringIO()):
+            call_command('prune_idempotency_keys', days=7, chunk_size=1)
+
+        self.assertEqual(list(models.OrderIdempotencyKey.objects.values_list('id', flat=True)), [fresh.id])
+
+
+class OrderPaymentSaveTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        order = make_order(coupon=make(Coupon), payment_type=make(PaymentType))
+        for price in (100, 250):
+            make(models.OrderItem, order=order, quantity=2, price=Decimal(price))
+        cls.order_id = order.id
+
+    def get_updated_columns(self, queries):
+        """Колонки заказа из UPDATE ... SET и признак запроса позиций заказа"""
+        columns = set()
+        for query in queries:
+            self.assertNotIn('orders_orderitem', query['sql'])
+            if query['sql'].startswith('UPDATE "orders_order"'):
+                set_clause = query['sql'].split(' SET ', 1)[1].split(' WHERE ', 1)[0]
+                columns.update(re.findall(r'"(\w+)" = ', set_clause))
+        return columns
+
+    def test_accept_payment(self):
+        order = models.Order.objects.get(id=self.order_id)
+
+        with CaptureQueriesContext(connection) as queries:
+            service.accept_payment(order)
+
+        self.assertEqual(self.get_updated_columns(queries), {'payment_status', 'updated'})
+
+    def test_update_payment_status(self):
+        order = models.Order.objects.select_related('payment_type').get(id=self.order_id)
+        result = {'OrderStatus': PaymentStatusEnum.PAID, 'depositAmount': 10000}
+        api = mock.Mock(**{'return_value.check_order.return_value': result})
+
+        with mock.patch.multiple(
+            service, check_alpha_order_status=mock.Mock(return_value=result), PodeliAPI=api,
+            PayselectionAPI=api, PayselectionRusAPI=api, YookassaAPI=api
+        ), CaptureQueriesContext(connection) as queries:
+            service.update_payment_status(order)
+
+        self.assertEqual(self.get_updated_columns(queries), {'income', 'payment_status', 'updated'})
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, PaymentStatusEnum.PAID)
+        self.assertEqual(order.income, Decimal(100))
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CalcPriceCacheTestCase(TestCase):
+    def setUp(self):
+        cache.cache.clear()
+        self.user = make(get_user_model())
+        self.cart_item = make(CartItem)
+        self.request = RequestFactory().post('/api/orders/calc-price/')
+        self.data = {'coupon': 'SALE', 'delivery_type': 1, 'payment_type': 2, 'region': 3}
+        self.compute = mock.Mock(return_value=({'discount_amount': Decimal(10)}, None))
+
+    def calc(self, data=None):
+        with mock.patch.object(service, 'get_cart', return_value=(self.cart_item.cart, True)):
+            key = service.get_calc_price_cache_key(self.request, data or self.data, user=self.user)
+            return cache.memoize_calc_price(key, self.compute)
+
+    def test_repeat_without_queries(self):
+        self.calc()
+
+        with self.assertNumQueries(0):
+            result, errors = self.calc()
+
+        self.assertEqual(result, {'discount_amount': Decimal(10)})
+        self.assertIsNone(errors)
+        self.assertEqual(self.compute.call_count, 1)
+
+    def test_cart_change(self):
+        self.calc()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cart_item.quantity += 1
+            self.cart_item.save()
+        self.calc()
+
+        self.assertEqual(self.compute.call_count, 2)
+
+    def test_coupon_usage(self):
+        coupon = make(Coupon, passphrase='SALE')
+        self.calc()
+        self.calc({**self.data, 'coupon': 'OTHER'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            make(CouponEntry, coupon=coupon)
+        self.calc()
+        self.calc({**self.data, 'coupon': 'OTHER'})
+
+        # использование SALE не сбрасывает расчеты с другими промокодами
+        self.assertEqual(self.compute.call_count, 3)
+
+
+class OrderHistoryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make(get_user_model())
+        cls.orders = [make_order(user=cls.user) for _ in range(5)]
+
+    def setUp(self):
+        cache.cache.clear()
+
+    def get(self, path='/api/orders/history/', **extra):
+        request = APIRequestFactory().get(path, **extra)
+        force_authenticate(request, user=self.user)
+        return views.OrderHistoryView.as_view({'get': 'list'})(request)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OrderHistoryPaginationTestCase(OrderHistoryTestCase):
+    def test_cursor(self):
+        order_numbers = []
+        response = self.get('/api/orders/history/?page_size=2')
+        while True:
+            self.assertLessEqual(len(response.data['results']), 2)
+            order_numbers += [order['order_number'] for order in response.data['results']]
+            if response.data['next'] is None:
+                break
+            response = self.get(response.data['next'].split('testserver', 1)[1])
+
+        expected = [order.order_number for order in sorted(self.orders, key=lambda x: (x.created, x.id))]
+        self.assertEqual(order_numbers, expected[::-1])
+
+    def test_without_pagination(self):
+        response = self.get()
+
+        self.assertEqual(len(response.data), len(self.orders))
+
+    def test_page_size(self):
+        pagination = OrderHistoryCursorPagination()
+        for value, page_size in (('1000', 100), ('0', 1), ('abc', 20), ('5', 5)):
+            request = Request(APIRequestFactory().get('/', {'page_size': value}))
+            self.assertEqual(pagination.get_page_size(request), page_size)
+
+    def test_invalid_cursor(self):
+        response = self.get('/api/orders/history/?cursor=invalid')
+
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OrderHistoryCacheTestCase(OrderHistoryTestCase):
+    def test_not_modified(self):
+        etag = self.get()['ETag']
+
+        for if_none_match in (etag, f'W/{etag}', f'"other", {etag}', '*'):
+            response = self.get(HTTP_IF_NONE_MATCH=if_none_match)
+            self.assertEqual(response.status_code, 304, if_none_match)
+            self.assertEqual(response['ETag'], etag)
+
+    def test_modified(self):
+        etag = self.get()['ETag']
+
+        # заголовок, содержащий ETag как подстроку, не совпадает с ним
+        for if_none_match in ('"other"', f'"x{etag}"'):
+            response = self.get(HTTP_IF_NONE_MATCH=if_none_match)
+            self.assertEqual(response.status_code, 200, if_none_match)
+
+    def test_order_save(self):
+        etag = self.get()['ETag']
+
+        order = self.orders[0]
+        order.comment = 'Новый комментарий'
+        order.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OrderHistoryListRendererTestCase(OrderHistoryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        card = make(ProductOfferCard)
+        for order in cls.orders[:3]:
+            make(models.OrderItem, order=order, card=card, size='M', quantity=2, price=Decimal(100))
+            make(models.OrderItem, order=order, quantity=1, price=Decimal('99.90'))
+
+    def get_context(self, path='/api/orders/history/'):
+        request = Request(APIRequestFactory().get(path))
+        request.user = self.user
+        view = views.OrderHistoryView(request=request, format_kwarg=None, action='list', args=(), kwargs={})
+        return view.get_serializer_context()
+
+    def assert_same_output(self, context):
+        orders = models.Order.objects.get_list(user=self.user)
+        serialized = serializers.OrderHistorySerializer(orders, many=True, context=context).data
+
+        renderer = serializers.OrderHistoryListRenderer(context)
+        rendered = renderer.render(
+            list(models.Order.objects.get_list_values(user=self.user, columns=renderer.columns))
+        )
+
+        self.assertEqual(JSONRenderer().render(rendered), JSONRenderer().render(serialized))
+
+    def test_same_output(self):
+        self.assert_same_output(self.get_context())
+
+    def test_sparse_fields(self):
+        context = self.get_context('/api/orders/history/?fields=order_number,items.price')
+        self.assert_same_output(context)
+
+        response = self.get('/api/orders/history/?fields=order_number,items.price')
+        self.assertEqual(set(response.data[0]), {'order_number', 'items'})
+        for item in response.data[0]['items']:
+            self.assertEqual(set(item), {'price'})
+
+    def test_unknown_fields(self):
+        response = self.get('/api/orders/history/?fields=order_number,password')
+
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class SendOrderNotificationsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.order = make_order()
+
+    def enqueue(self, kind=OrderNotificationKindEnum.ORDER_CUSTOMER, **kwargs):
+        notification = service.enqueue_order_notifications(self.order, [kind], **kwargs)[0]
+        notification.refresh_from_db()
+        return notification
+
+    def test_send(self):
+        notification = self.enqueue()
+
+        self.assertEqual(service.send_order_notifications(), (1, 0))
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.order.email])
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, OrderNotificationStatusEnum.SENT)
+        self.assertEqual(notification.attempts, 1)
+
+    def test_sent_once(self):
+        self.enqueue()
+
+        service.send_order_notifications()
+        self.assertEqual(service.send_order_notifications(), (0, 0))
+
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_trigger_request(self):
+        request = RequestFactory().post('/api/orders/fast/', HTTP_USER_AGENT='test')
+        notification = self.enqueue(OrderNotificationKindEnum.FAST_ORDER_TRIGGER, request=request)
+
+        restored = service.get_notification_request(notification)
+
+        self.assertEqual(restored.get_host(), request.get_host())
+        self.assertEqual(restored.path, request.path)
+        self.assertEqual(restored.META['HTTP_USER_AGENT'], 'test')
+
+    def test_retry(self):
+        notification = self.enqueue()
+
+        with mock.patch.object(service, 'send_order_notification', side_effect=ConnectionError):
+            self.assertEqual(service.send_order_notifications(), (0, 1))
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, OrderNotificationStatusEnum.NEW)
+        self.assertEqual(notification.attempts, 1)
+        self.assertGreater(notification.next_attempt, timezone.now())
+        self.assertIn('ConnectionError', notification.error)
+
+        models.OrderNotification.objects.filter(id=notification.id).update(next_attempt=timezone.now())
+        self.assertEqual(service.send_order_notifications(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_failed(self):
+        notification = self.enqueue()
+        models.OrderNotification.objects.filter(id=notification.id).update(
+            attempts=service.NOTIFICATION_MAX_ATTEMPTS - 1
+        )
+
+        with mock.patch.object(service, 'send_order_notification', side_effect=ConnectionError):
+            service.send_order_notifications()
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, OrderNotificationStatusEnum.FAILED)
+        self.assertEqual(notification.attempts, service.NOTIFICATION_MAX_ATTEMPTS)
+
+    def test_claimed(self):
+        notification = self.enqueue()
+
+        # уведомление, которое забрал упавший воркер, ждет окончания аренды
+        service.claim_order_notifications(batch_size=10)
+        self.assertEqual(service.send_order_notifications(), (0, 0))
+
+        models.OrderNotification.objects.filter(id=notification.id).update(
+            next_attempt=timezone.now() - datetime.timedelta(seconds=1)
+        )
+        self.assertEqual(service.send_order_notifications(), (1, 0))
+        notification.refresh_from_db()
+        self.assertEqual(notification.attempts, 2)
+
+
+class RetailCRMPayloadsTestCase(TestCase):
+    # заказы со связями и позиции с предложениями
+    batch_queries = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        color_value_model = ProductOffer._meta.get_field('color_value').related_model
+        offers = [make(ProductOffer, color_value=make(color_value_model)) for _ in range(2)]
+        deliveries = (
+            {'delivery_point': make(DeliveryListPoint)},
+            {'self_delivery_point': make(SelfDeliveryPoint)},
+            {'street': 'Ленина', 'building': '1', 'apartment': '2'},
+        )
+        for delivery in deliveries:
+            order = make_order(
+                user=make(get_user_model()), region=make(Region), coupon=make(Coupon),
+                payment_type=make(PaymentType), comment='Комментарий', **delivery
+            )
+            for offer in offers:
+                make(models.OrderItem, order=order, offer=offer, quantity=2, price=Decimal(100))
+
+    def test_batch_payloads(self):
+        single = [service.get_order_data(order) for order in models.Order.objects.order_by('id')]
+
+        with CaptureQueriesContext(connection) as queries:
+            batch = service.get_orders_data(models.Order.objects.order_by('id'))
+
+        self.assertEqual(batch, single)
+        self.assertLessEqual(len(queries), self.batch_queries)
+
+
+class GetUploadedIdsTestCase(TestCase):
+    payloads = [{'number': 'A1'}, {'number': 'A2'}, {'number': 'A3'}]
+
+    def test_by_number(self):
+        result = {'uploadedOrders': [{'id': 3, 'number': 'A3'}, {'id': 1, 'number': 'A1'}]}
+
+        self.assertEqual(service.get_uploaded_ids(result, self.payloads), [1, None, 3])
+
+    def test_by_position(self):
+        # ошибки приходят списком по индексам пачки или словарем с индексами-ключами
+        for errors in ([None, 'Ошибка'], {'1': 'Ошибка'}, {1: 'Ошибка'}):
+            with self.subTest(errors=errors):
+                result = {'uploadedOrders': [{'id': 1}, {'id': 3}], 'errors': errors}
+
+                self.assertEqual(service.get_uploaded_ids(result, self.payloads), [1, None, 3])
+
+    def test_count_mismatch(self):
+        result = {'uploadedOrders': [{'id': 1}, {'id': 2}]}
+
+        self.assertEqual(service.get_uploaded_ids(result, self.payloads), [None, None, None])
+
+
+class RecordRetailCRMUploadTestCase(TestCase):
+    def make_sync(self, **values):
+        order = make_order()
+        models.RetailCRMOrderSync.objects.update_or_create(order=order, defaults=values)
+        return models.Order.objects.select_related('retailcrm_sync').get(id=order.id)
+
+    def record(self, order, success):
+        service.record_retailcrm_upload({order: success})
+        return models.RetailCRMOrderSync.objects.get(order=order)
+
+    def test_success(self):
+        sync = self.record(self.make_sync(), True)
+
+        self.assertEqual(sync.status, RetailCRMSyncStatusEnum.UPLOADED)
+        self.assertEqual(sync.attempts, 1)
+
+    def test_backoff(self):
+        order = self.make_sync()
+        now = timezone.now()
+
+        with mock.patch.object(timezone, 'now', return_value=now):
+            for attempts in range(1, 4):
+                sync = self.record(order, False)
+                order.retailcrm_sync = sync
+
+                self.assertEqual(sync.status, RetailCRMSyncStatusEnum.PENDING)
+                self.assertEqual(sync.attempts, attempts)
+                self.assertEqual(
+                    sync.next_attempt, now + service.RETAIL_CRM_RETRY_DELAY * 2 ** (attempts - 1)
+                )
+
+    def test_dead(self):
+        order = self.make_sync(attempts=service.RETAIL_CRM_MAX_ATTEMPTS - 1)
+        next_attempt = order.retailcrm_sync.next_attempt
+
+        sync = self.record(order, False)
+
+        self.assertEqual(sync.status, RetailCRMSyncStatusEnum.DEAD)
+        self.assertEqual(sync.attempts, service.RETAIL_CRM_MAX_ATTEMPTS)
+        self.assertEqual(sync.next_attempt, next_attempt)
+
+        # DEAD из очереди больше не выбирается
+        self.assertNotIn(order, service.get_orders_for_retailcrm_upload())
+
+
+class ApplyRetailCRMStatusesTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.new = make(OrderStatus, title='Новый')
+        cls.complete = make(OrderStatus, title='Выполнен')
+        cls.statuses_codes = {'new': cls.new, 'complete': cls.complete}
+        cls.by_id = make_order(status=cls.new)
+        cls.by_retailcrm_id = make_order(status=cls.new, retailcrm_id=500)
+        cls.unchanged = make_order(status=cls.complete)
+
+    def get_logs(self):
+        return set(models.OrderStatusLog.objects.values_list('order_id', 'status_id'))
+
+    def test_apply(self):
+        logs = self.get_logs()
+        crm_orders = [
+            {'status': 'complete', 'externalId': str(self.by_id.id)},
+            {'status': 'complete', 'id': 500},
+            {'status': 'complete', 'externalId': str(self.unchanged.id)},
+            {'status': 'unknown', 'externalId': str(self.unchanged.id)},
+            {'status': 'complete', 'externalId': 'not-a-number'},
+            {'status': 'complete', 'id': 999},
+        ]
+
+        changed = service.apply_retailcrm_statuses(crm_orders, statuses_codes=self.statuses_codes)
+
+        self.assertEqual(changed, 2)
+        for order in (self.by_id, self.by_retailcrm_id, self.unchanged):
+            order.refresh_from_db()
+            self.assertEqual(order.status, self.complete)
+        self.assertEqual(self.get_logs() - logs, {
+            (self.by_id.id, self.complete.id), (self.by_retailcrm_id.id, self.complete.id)
+        })
+
+    def test_unknown_statuses(self):
+        crm_orders = [{'status': 'unknown', 'externalId': str(self.by_id.id)}]
+
+        with self.assertNumQueries(0):
+            changed = service.apply_retailcrm_statuses(crm_orders, statuses_codes=self.statuses_codes)
+
+        self.assertEqual(changed, 0)
+
+
+class SyncOrderStatusesFromHistoryTestCase(TestCase):
+    def get_client(self, *pages):
+        client = mock.Mock()
+        client.orders_history.return_value.get_response.side_effect = [
+            {'success': True, 'history': history} for history in pages
+        ]
+        return client
+
+    @staticmethod
+    def status_change(change_id, status, **order):
+        return {'id': change_id, 'field': 'status', 'newValue': {'code': status}, 'order': order}
+
+    def test_resume(self):
+        service.set_retailcrm_cursor(service.ORDERS_HISTORY_CURSOR, 42)
+        client = self.get_client([self.status_change(43, 'complete', id=1)])
+
+        with mock.patch.object(service, 'apply_retailcrm_statuses') as apply_statuses:
+            processed = service.sync_order_statuses_from_retailcrm_history(retailcrm_client=client)
+
+        self.assertEqual(processed, 1)
+        client.orders_history.assert_called_once_with(filters={'sinceId': '42'}, limit=100)
+        self.assertEqual(list(apply_statuses.call_args[0][0]), [{'status': 'complete', 'id': 1}])
+        self.assertEqual(service.get_retailcrm_cursor(service.ORDERS_HISTORY_CURSOR), '43')
+
+    def test_external_ids(self):
+        client = self.get_client([
+            self.status_change(1, 'new', externalId=10),
+            self.status_change(2, 'new', externalId=11),
+            self.status_change(3, 'complete', externalId=10),
+        ])
+
+        with mock.patch.object(service, 'apply_retailcrm_statuses') as apply_statuses:
+            service.sync_order_statuses_from_retailcrm_history(
+                retailcrm_client=client, start_date=datetime.date(2026, 1, 1)
+            )
+
+        client.orders_history.assert_called_once_with(filters={'startDate': '2026-01-01'}, limit=100)
+        self.assertEqual(list(apply_statuses.call_args[0][0]), [
+            {'status': 'complete', 'externalId': 10}, {'status': 'new', 'externalId': 11}
+        ])
+
+    def test_start_date_required(self):
+        with self.assertRaises(ValueError):
+            service.sync_order_statuses_from_retailcrm_history(retailcrm_client=mock.Mock())
+
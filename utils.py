@@ -1,13 +1,68 @@
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connection
 from django.db.models.functions import Length
 
 
 FIRST_ORDER = 110
+ORDER_NUMBER_SEQUENCE = 'orders_order_number_seq'
 
 
-def generate_order_number():
+class OrderNumberAllocator:
+    """Выдает номера заказов из последовательности БД.
+
+    nextval() не блокирует строк и не откатывается вместе с транзакцией, поэтому параллельные
+    заказы не получают одинаковых номеров. Номера запрашиваются блоками по block_size за один
+    запрос и раздаются из памяти процесса (после fork блок сбрасывается)
+    """
+
+    def __init__(self, block_size=1, sequence=ORDER_NUMBER_SEQUENCE):
+        self.block_size = max(int(block_size), 1)
+        self.sequence = sequence
+        self._lock = threading.Lock()
+        self._numbers = deque()
+        self._pid = None
+
+    def allocate(self) -> str:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._numbers.clear()
+                self._pid = os.getpid()
+
+            if not self._numbers:
+                self._numbers.extend(self.fetch_block())
+
+            return str(self._numbers.popleft())
+
+    def fetch_block(self) -> list:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT nextval(%s) FROM generate_series(1, %s)',
+                [self.sequence, self.block_size]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+order_number_allocator = OrderNumberAllocator(
+    block_size=getattr(settings, 'ORDER_NUMBER_BLOCK_SIZE', 1)
+)
+
+
+def generate_order_number_from_orders():
+    """Следующий номер по последнему заказу (для БД без последовательностей)"""
     from orders.models import Order
 
     last_order = Order.objects.order_by(Length('order_number').desc(), '-order_number').first()
     last_order_number = int(last_order.order_number) if last_order else FIRST_ORDER
 
     return f'{last_order_number + 1}'
+
+
+def generate_order_number():
+    if connection.vendor != 'postgresql':
+        return generate_order_number_from_orders()
+
+    return order_number_allocator.allocate()